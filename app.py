@@ -1,21 +1,54 @@
-from flask import Flask, request, jsonify, send_from_directory, render_template_string, session, send_file
+from flask import Flask, request, jsonify, send_from_directory, render_template_string, session, send_file, Response, stream_with_context
 import numpy as np
 import cv2
 import base64
 import os
-from face_utils import save_face_image, recognize_faces_and_liveness_sequence, mark_attendance, get_attendance_status, mark_attendance_status, save_user_data, fetch_all_users, fetch_user_by_name, delete_user, fetch_all_attendance, fetch_face_image, fetch_attendance_by_date
+from face_utils import save_face_image, mark_attendance, get_attendance_status, mark_attendance_status, save_user_data, update_user, get_roster, fetch_user_by_name, delete_user, fetch_face_image, fetch_attendance_page, iter_attendance, fetch_daily_summaries, get_daily_summary, get_attendance_streaks, load_gallery, warm_up_models, get_model_stats, get_gallery_stats, auto_enrol, notification_queue, DETECTION_POLICIES
 from datetime import datetime
 import csv
 import io
+import struct
+import atexit
+import json
+import multiprocessing
+import time
+import queue
+from recognition_service import recognition_service, ServiceBusy, ServiceUnavailable
+from encoding_batcher import encoding_batcher
+from embedding_cache import embedding_cache
+from live_sessions import live_sessions, LIVE_MAX_FPS
 
 app = Flask(__name__, static_folder='static')
 app.secret_key = 'your_secret_key_here'  
 
 ADMIN_PASSWORD = 'abhay123'  
 
+# Load the precomputed face encodings once at startup. Recognition runs in
+# the worker processes of recognition_service, which load their own models;
+# with RECOGNITION_WORKERS=0 it runs here and the models are warmed up now.
+# Also delivers queued attendance emails in the background.
+# Only the serving process calls this: spawned recognition workers re-run
+# this module and must do nothing but their own _worker_init.
+def start_services():
+    load_gallery()
+    if recognition_service.workers <= 0:
+        warm_up_models()
+    recognition_service.start()
+    atexit.register(recognition_service.stop)
+
+    notification_queue.start()
+    atexit.register(notification_queue.stop)
+
 def is_admin():
     return session.get('is_admin', False)
 
+def is_valid_date(date):
+    try:
+        datetime.strptime(date, '%Y-%m-%d')
+        return True
+    except (TypeError, ValueError):
+        return False
+
 def admin_required(f):
     from functools import wraps
     @wraps(f)
@@ -37,25 +70,123 @@ def static_files(filename):
 
 def read_image_from_request(img_data_b64):
     img_bytes = base64.b64decode(img_data_b64)
+    return decode_image(img_bytes)
+
+def decode_image(img_bytes):
     nparr = np.frombuffer(img_bytes, np.uint8)
     img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
     return img
 
+# Limits for binary frame uploads
+MAX_UPLOAD_FRAMES = 60
+MAX_FRAME_BYTES = 8 * 1024 * 1024
+
+def _read_exact(stream, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = stream.read(size - len(buf))
+        if not chunk:
+            break
+        buf.extend(chunk)
+    return bytes(buf)
+
+def read_frames_from_stream(stream):
+    # Length-prefixed binary stream: repeated [uint32 big-endian length][JPEG bytes].
+    # Frames are decoded one by one as they are read off the socket.
+    for _ in range(MAX_UPLOAD_FRAMES):
+        header = _read_exact(stream, 4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise ValueError('Truncated frame header')
+        (size,) = struct.unpack('>I', header)
+        if size == 0 or size > MAX_FRAME_BYTES:
+            raise ValueError(f'Invalid frame size {size}')
+        data = _read_exact(stream, size)
+        if len(data) < size:
+            raise ValueError('Truncated frame data')
+        yield decode_image(data)
+    if stream.read(1):
+        raise ValueError(f'Too many frames (max {MAX_UPLOAD_FRAMES})')
+
+def read_frames_from_multipart(files):
+    parts = files.getlist('frames')
+    if len(parts) > MAX_UPLOAD_FRAMES:
+        raise ValueError(f'Too many frames (max {MAX_UPLOAD_FRAMES})')
+    for part in parts:
+        yield decode_image(part.read())
+
+# What clients should send: frames scaled to a short side of short_side
+# pixels, JPEG quality within jpeg_quality (picked adaptively by the
+# client), and once faces are being tracked, only crops around them padded
+# by crop_padding, with a full frame every full_frame_every frames so new
+# faces are noticed.
+CAPTURE_SETTINGS = {
+    'short_side': int(os.environ.get('CAPTURE_SHORT_SIDE', 480)),
+    'jpeg_quality': [0.5, 0.9],
+    'crop_padding': 0.5,
+    'full_frame_every': 10,
+}
+MAX_FRAME_SIDE = 4096
+
+def assemble_frame(width, height, crops):
+    # Paste crop-only uploads, [(x, y, image)], into a blank frame of the
+    # original size so the recognisers see each face where it was
+    width, height = int(width), int(height)
+    if not (0 < width <= MAX_FRAME_SIDE and 0 < height <= MAX_FRAME_SIDE):
+        raise ValueError('Invalid frame size')
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    for x, y, img in crops:
+        if img is None:
+            raise ValueError('Could not decode crop')
+        x, y = int(x), int(y)
+        h, w = img.shape[:2]
+        if x < 0 or y < 0 or x + w > width or y + h > height:
+            raise ValueError('Crop outside the frame')
+        frame[y:y + h, x:x + w] = img
+    return frame
+
+def read_json_frame(item):
+    # A frame in a JSON upload: a base64 JPEG, or crops with their offsets,
+    # {'width': W, 'height': H, 'crops': [{'x': X, 'y': Y, 'image': base64 JPEG}, ...]}
+    if isinstance(item, str):
+        return read_image_from_request(item)
+    crops = [(crop['x'], crop['y'], read_image_from_request(crop['image'])) for crop in item['crops']]
+    return assemble_frame(item['width'], item['height'], crops)
+
+def read_crop_frame(layout, body):
+    # Binary crop-only frame: layout is the X-Frame-Layout header,
+    # {"width": W, "height": H, "crops": [[x, y], ...]}, and the body holds
+    # the crops as a length-prefixed JPEG stream in the same order
+    layout = json.loads(layout)
+    offsets = layout['crops']
+    imgs = list(read_frames_from_stream(io.BytesIO(body)))
+    if len(imgs) != len(offsets):
+        raise ValueError('Crop count does not match the layout')
+    return assemble_frame(layout['width'], layout['height'],
+                          [(x, y, img) for (x, y), img in zip(offsets, imgs)])
+
+@app.route('/capture_settings', methods=['GET'])
+def capture_settings():
+    return jsonify(CAPTURE_SETTINGS)
+
 @app.route('/register', methods=['POST'])
 def register():
     data = request.json
     name = data.get('name')
     email = data.get('email')
     rollno = data.get('rollno')
+    class_name = data.get('class_name')
     img_b64 = data.get('image')
     if not name or not email or not rollno or not img_b64:
         return jsonify({'success': False, 'error': 'Missing name, email, rollno, or image'}), 400
 
     # Decode the image and save it to the database
     img_bytes = base64.b64decode(img_b64)
-    save_user_data(name, email, rollno, img_bytes)
+    face_encoded = save_user_data(name, email, rollno, img_bytes, class_name)
 
-    return jsonify({'success': True, 'message': f'{name} registered with email {email} and rollno {rollno}'})
+    return jsonify({'success': True, 'face_encoded': face_encoded,
+                    'message': f'{name} registered with email {email} and rollno {rollno}'})
 
 @app.route('/attendance', methods=['POST'])
 def attendance():
@@ -63,23 +194,175 @@ def attendance():
     images_b64 = data.get('images')
     if not images_b64 or not isinstance(images_b64, list):
         return jsonify({'success': False, 'error': 'Missing images'}), 400
-    imgs = [read_image_from_request(b64) for b64 in images_b64]
-    results = recognize_faces_and_liveness_sequence(imgs)
+    try:
+        imgs = [read_json_frame(item) for item in images_b64]
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'success': False, 'error': f'Invalid frame: {e}'}), 400
+    return process_attendance_frames(imgs, 'attendance')
+
+@app.route('/attendance_frames', methods=['POST'])
+def attendance_frames():
+    # Binary upload: either multipart/form-data with one 'frames' part per
+    # JPEG, or an application/octet-stream body of length-prefixed JPEGs
+    try:
+        if request.mimetype == 'multipart/form-data':
+            imgs = list(read_frames_from_multipart(request.files))
+        else:
+            imgs = list(read_frames_from_stream(request.stream))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    if not imgs:
+        return jsonify({'success': False, 'error': 'Missing images'}), 400
+    return process_attendance_frames(imgs, 'attendance_frames')
+
+# Face detection policy per endpoint: 'fast', 'cascade' (fast detector,
+# CNN only when unsure) or 'cnn' (see face_utils.detect_faces). A request
+# can pick another with ?detector=...
+ENDPOINT_DETECTION_POLICY = {
+    'attendance': os.environ.get('ATTENDANCE_DETECTOR', 'cascade'),
+    'attendance_frames': os.environ.get('ATTENDANCE_FRAMES_DETECTOR', 'cascade'),
+    'live_session': os.environ.get('LIVE_SESSION_DETECTOR', 'fast'),
+}
+
+def process_attendance_frames(imgs, endpoint):
+    detector_policy = request.args.get('detector', ENDPOINT_DETECTION_POLICY[endpoint])
+    if detector_policy not in DETECTION_POLICIES:
+        return jsonify({'success': False, 'error': f"detector must be one of {', '.join(DETECTION_POLICIES)}"}), 400
+    imgs = [img for img in imgs if img is not None]
+    if not imgs:
+        return jsonify({'success': False, 'error': 'Could not decode images'}), 400
+    try:
+        results, stats = recognition_service.recognize_sequence(imgs, detector_policy)
+    except ServiceBusy:
+        return jsonify({'success': False, 'error': 'Recognition is busy, try again shortly'}), 429, {'Retry-After': '1'}
+    except ServiceUnavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
     marked = []
+    newly_marked = []
     for res in results:
+        encoding = res.pop('encoding', None)
         if res['name'] and res['liveness']:
-            mark_attendance(res['name'])
+            if mark_attendance(res['name']):
+                newly_marked.append(res['name'])
             marked.append(res['name'])
-    return jsonify({'success': True, 'names': marked, 'details': results})
+            if encoding is not None:
+                auto_enrol(res['name'], encoding, res['distance'])
+    return jsonify({'success': True, 'names': marked, 'newly_marked': newly_marked,
+                    'details': results, 'frames': stats})
+
+# Live attendance: POST /live_session opens a session, the kiosk POSTs one
+# JPEG at a time to /live_session/<id>/frame (sending the next after the
+# previous returns, at most max_fps per second) and listens on
+# /live_session/<id>/events, a server-sent event stream of 'face',
+# 'liveness' and 'marked' events. DELETE /live_session/<id> ends it.
+LIVE_KEEPALIVE_SECONDS = 15
+
+@app.route('/live_session', methods=['POST'])
+def create_live_session():
+    detector_policy = request.args.get('detector', ENDPOINT_DETECTION_POLICY['live_session'])
+    if detector_policy not in DETECTION_POLICIES:
+        return jsonify({'success': False, 'error': f"detector must be one of {', '.join(DETECTION_POLICIES)}"}), 400
+    live = live_sessions.create(detector_policy)
+    if live is None:
+        return jsonify({'success': False, 'error': 'Too many live sessions'}), 503
+    return jsonify({'success': True, 'session_id': live.id, 'max_fps': LIVE_MAX_FPS, 'capture': CAPTURE_SETTINGS})
+
+@app.route('/live_session/<session_id>/frame', methods=['POST'])
+def live_session_frame(session_id):
+    live = live_sessions.get(session_id)
+    if live is None:
+        return jsonify({'success': False, 'error': 'Unknown or expired session'}), 404
+    # Either one whole JPEG frame, or crops described by X-Frame-Layout
+    body = request.get_data(cache=False)
+    if not body or len(body) > MAX_FRAME_BYTES:
+        return jsonify({'success': False, 'error': 'Expected one JPEG frame'}), 400
+    # Time spent here once the frame has arrived, so the client can tell its
+    # upload time apart from recognition
+    received = time.perf_counter()
+    layout = request.headers.get('X-Frame-Layout')
+    try:
+        img = read_crop_frame(layout, body) if layout else decode_image(body)
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'success': False, 'error': f'Invalid frame: {e}'}), 400
+    if img is None:
+        return jsonify({'success': False, 'error': 'Could not decode image'}), 400
+    try:
+        result = live.process_frame(img)
+    except ServiceBusy:
+        return jsonify({'success': False, 'error': 'Recognition is busy, try again shortly'}), 429, {'Retry-After': '1'}
+    except ServiceUnavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
+    if result is None:
+        return jsonify({'success': False, 'error': 'Previous frame still processing'}), 429, {'Retry-After': '0'}
+    events, tracks = result
+    for event in list(events):
+        encoding = event.pop('encoding', None)
+        if event['event'] == 'liveness' and event['name']:
+            events.append({'event': 'marked', 'track_id': event['track_id'], 'name': event['name'],
+                           'newly_marked': mark_attendance(event['name'])})
+            if encoding is not None:
+                auto_enrol(event['name'], encoding, event['distance'])
+    live.publish(events)
+    # Current face boxes, for the client to crop the next frame around
+    return (jsonify({'success': True, 'events': events, 'tracks': tracks}),
+            {'X-Processing-Ms': f'{(time.perf_counter() - received) * 1000:.1f}'})
+
+@app.route('/live_session/<session_id>/events', methods=['GET'])
+def live_session_events(session_id):
+    live = live_sessions.get(session_id)
+    if live is None:
+        return jsonify({'success': False, 'error': 'Unknown or expired session'}), 404
+    events = live.subscribe()
+
+    def generate():
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=LIVE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if event is None:
+                    return
+                yield f'data: {json.dumps(event)}\n\n'
+        finally:
+            live.unsubscribe(events)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/live_session/<session_id>', methods=['DELETE'])
+def close_live_session(session_id):
+    if not live_sessions.close(session_id):
+        return jsonify({'success': False, 'error': 'Unknown or expired session'}), 404
+    return jsonify({'success': True})
+
+# Attendance log pagination and CSV export chunking
+LOG_PAGE_SIZE = 100
+LOG_MAX_PAGE_SIZE = 1000
+CSV_CHUNK_ROWS = 500
 
 @app.route('/attendance_log', methods=['GET'])
 def attendance_log():
-    # Return attendance log as JSON
+    # Return one page of the attendance log as JSON.
+    # ?start=YYYY-MM-DD&end=YYYY-MM-DD&name=...&limit=N&after_id=ID
+    start = request.args.get('start')
+    end = request.args.get('end')
+    name = request.args.get('name')
+    if (start and not is_valid_date(start)) or (end and not is_valid_date(end)):
+        return jsonify({'success': False, 'error': 'Invalid date, expected YYYY-MM-DD'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', LOG_PAGE_SIZE)), 1), LOG_MAX_PAGE_SIZE)
+        after_id = request.args.get('after_id')
+        after_id = int(after_id) if after_id else None
+    except ValueError:
+        return jsonify({'success': False, 'error': 'limit and after_id must be integers'}), 400
     records = []
-    for record in fetch_all_attendance():
-        name, date, time, status = record
-        records.append({'name': name, 'date': date, 'time': time, 'status': status})
-    return jsonify({'records': records})
+    for record in fetch_attendance_page(start, end, name, after_id, limit):
+        record_id, name, date, time, status = record
+        records.append({'id': record_id, 'name': name, 'date': date, 'time': time, 'status': status})
+    next_after_id = records[-1]['id'] if len(records) == limit else None
+    return jsonify({'records': records, 'next_after_id': next_after_id})
 
 @app.route('/attendance_status', methods=['GET'])
 def attendance_status():
@@ -87,9 +370,19 @@ def attendance_status():
     date = request.args.get('date')
     if not date:
         date = datetime.now().strftime('%Y-%m-%d')
+    if not is_valid_date(date):
+        return jsonify({'success': False, 'error': 'Invalid date, expected YYYY-MM-DD'}), 400
     status = get_attendance_status(date)
     return jsonify({'date': date, 'status': status})
 
+@app.route('/model_stats', methods=['GET'])
+def model_stats():
+    # Model load time vs. inference time since startup, how many faces each
+    # batched encoder call carried, enrolment embedding cache hits, and
+    # gallery size / memory
+    return jsonify({'models': get_model_stats(), 'encoding_batches': encoding_batcher.stats,
+                    'embedding_cache': embedding_cache.stats, 'gallery': get_gallery_stats()})
+
 @app.route('/login', methods=['POST'])
 def login():
     data = request.json
@@ -116,18 +409,17 @@ def manual_attendance():
     name = data.get('name')
     date = data.get('date')
     status = data.get('status')  # 'present' or 'absent'
-    if not name or not date or status not in ['present', 'absent']:
+    if not name or not is_valid_date(date) or status not in ['present', 'absent']:
         return jsonify({'success': False, 'error': 'Missing or invalid parameters'}), 400
     mark_attendance_status(name, date, status)
     return jsonify({'success': True, 'message': f'{name} marked {status} for {date}'})
 
 @app.route('/users', methods=['GET'])
 def users():
-    # List registered users (names, emails, roll numbers)
+    # List registered users (names, emails, roll numbers, classes)
     users = []
-    for user in fetch_all_users():
-        name, email, rollno = user
-        users.append({'name': name, 'email': email, 'rollno': rollno})
+    for name, (email, rollno, class_name) in get_roster().items():
+        users.append({'name': name, 'email': email, 'rollno': rollno, 'class_name': class_name})
     return jsonify({'users': users})
 
 @app.route('/user/<name>/face', methods=['GET'])
@@ -151,54 +443,86 @@ def delete_user_route(name):
 @admin_required
 def download_attendance():
     date = request.args.get('date')
-    temp_path = 'attendance_export.csv'
-
-    with open(temp_path, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
+    if date and not is_valid_date(date):
+        return jsonify({'success': False, 'error': 'Invalid date, expected YYYY-MM-DD'}), 400
+    filename = f'attendance_{date}.csv' if date else 'attendance_export.csv'
+
+    def generate():
+        # Rows go straight from the database cursor to the response in
+        # chunks, so memory stays flat regardless of table size
+        buf = io.StringIO()
+        writer = csv.writer(buf)
         writer.writerow(['Name', 'Date (YYYY-MM-DD)', 'Time', 'Status'])  # Add column headers
-
-        if date:
-            # Fetch attendance for a specific date
-            records = fetch_attendance_by_date(date)
-        else:
-            # Fetch all attendance records
-            records = fetch_all_attendance()
-
-        for record in records:
-            name, record_date, time, status = record
-            # Ensure the date is in the format YYYY-MM-DD
-            formatted_date = datetime.strptime(record_date, '%Y-%m-%d').strftime('%Y-%m-%d')
-            writer.writerow([name, formatted_date, time, status])
-
-    resp = send_from_directory('.', temp_path, as_attachment=True)
-
-    # Clean up temp file after sending
-    import threading
-    threading.Timer(2.0, lambda: os.remove(temp_path)).start()
-
-    return resp
+        for i, record in enumerate(iter_attendance(date), start=1):
+            name, day, time, status = record
+            # Format the integer day as YYYY-MM-DD
+            writer.writerow([name, f'{day // 10000:04d}-{day // 100 % 100:02d}-{day % 100:02d}', time, status])
+            if i % CSV_CHUNK_ROWS == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 @app.route('/attendance_analytics', methods=['GET'])
 def attendance_analytics():
     date = request.args.get('date')
     if not date:
         date = datetime.now().strftime('%Y-%m-%d')
+    if not is_valid_date(date):
+        return jsonify({'success': False, 'error': 'Invalid date, expected YYYY-MM-DD'}), 400
 
-    # Fetch attendance status for the given date
-    status = get_attendance_status(date)
-    total_users = len(status)
-    present_count = sum(1 for s in status.values() if s == 'present')
-    absent_count = total_users - present_count
+    # Totals come from the precomputed daily summary; the per-user status
+    # map is only built when asked for with ?details=1
+    class_name = request.args.get('class_name')
+    total_users, present_count, absent_count = get_daily_summary(date, class_name)
     present_percentage = (present_count / total_users * 100) if total_users > 0 else 0
 
-    return jsonify({
+    response = {
         'date': date,
         'total_users': total_users,
         'present_count': present_count,
         'absent_count': absent_count,
         'present_percentage': round(present_percentage, 2),
-        'status': status
-    })
+    }
+    if request.args.get('details') == '1':
+        response['status'] = get_attendance_status(date)
+    return jsonify(response)
+
+@app.route('/attendance_analytics/range', methods=['GET'])
+def attendance_analytics_range():
+    # ?start=YYYY-MM-DD&end=YYYY-MM-DD[&class_name=...]
+    # Daily, weekly (ISO week) and monthly attendance rates over school days
+    start = request.args.get('start')
+    end = request.args.get('end')
+    if not is_valid_date(start) or not is_valid_date(end):
+        return jsonify({'success': False, 'error': 'start and end are required as YYYY-MM-DD'}), 400
+    class_name = request.args.get('class_name')
+
+    daily, weekly, monthly = [], {}, {}
+    for date, enrolled, present, absent in fetch_daily_summaries(start, end, class_name):
+        rate = round(present / enrolled * 100, 2) if enrolled else 0
+        daily.append({'date': date, 'enrolled': enrolled, 'present': present, 'absent': absent, 'rate': rate})
+        year, week, _ = datetime.strptime(date, '%Y-%m-%d').isocalendar()
+        for buckets, key in ((weekly, f'{year}-W{week:02d}'), (monthly, date[:7])):
+            bucket = buckets.setdefault(key, {'period': key, 'days': 0, 'enrolled': 0, 'present': 0})
+            bucket['days'] += 1
+            bucket['enrolled'] += enrolled
+            bucket['present'] += present
+    for bucket in list(weekly.values()) + list(monthly.values()):
+        bucket['rate'] = round(bucket['present'] / bucket['enrolled'] * 100, 2) if bucket['enrolled'] else 0
+
+    return jsonify({'start': start, 'end': end, 'class_name': class_name, 'daily': daily,
+                    'weekly': list(weekly.values()), 'monthly': list(monthly.values())})
+
+@app.route('/attendance_streaks/<name>', methods=['GET'])
+def attendance_streaks(name):
+    streaks = get_attendance_streaks(name)
+    if streaks is None:
+        return jsonify({'success': False, 'error': 'User not found'}), 404
+    return jsonify(streaks)
 
 @app.route('/edit_user', methods=['POST'])
 def edit_user():
@@ -206,30 +530,24 @@ def edit_user():
     name = data.get('name')
     new_email = data.get('email')
     new_rollno = data.get('rollno')
+    new_class_name = data.get('class_name')
 
     if not name or not new_email or not new_rollno:
         return jsonify({'success': False, 'error': 'Missing required fields'}), 400
 
-    updated = False
-    user_data_file = 'user_data.csv'
-    temp_file = 'user_data_temp.csv'
-
-    with open(user_data_file, 'r') as infile, open(temp_file, 'w', newline='') as outfile:
-        reader = csv.reader(infile)
-        writer = csv.writer(outfile)
-        for row in reader:
-            if row[0] == name:
-                writer.writerow([name, new_email, new_rollno])
-                updated = True
-            else:
-                writer.writerow(row)
-
-    if updated:
-        os.replace(temp_file, user_data_file)
+    if update_user(name, new_email, new_rollno, new_class_name):
         return jsonify({'success': True, 'message': 'User details updated successfully'})
     else:
-        os.remove(temp_file)
         return jsonify({'success': False, 'error': 'User not found'}), 404
 
+# Imported by a WSGI server: start here, but not in a spawned worker
+if __name__ != '__main__' and multiprocessing.current_process().name == 'MainProcess':
+    start_services()
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # With debug the reloader parent only watches files; the services run
+    # in the child it serves from
+    debug = True
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_services()
+    app.run(debug=debug)
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""
+Attendance query times before and after the indexed schema (migration 3).
+
+Builds two throwaway databases with the same synthetic attendance rows, one
+left at schema version 2 (text dates, only the (name, date) unique index) and
+one fully migrated, then times the dashboard queries on both. Example:
+
+    python benchmarks/bench_attendance_queries.py --rows 1000000 10000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from db import Database
+from migrations import MIGRATIONS, apply_migrations
+
+STUDENTS = 3000
+
+
+def populate(database, num_rows, with_day):
+    days = -(-num_rows // STUDENTS)
+    start = date(2024, 1, 1)
+    columns = 'name, date, day, time, status' if with_day else 'name, date, time, status'
+    marks = ', '.join('?' * len(columns.split(',')))
+
+    def rows():
+        count = 0
+        for d in range(days):
+            day = start + timedelta(days=d)
+            text, num = day.isoformat(), int(day.strftime('%Y%m%d'))
+            for s in range(STUDENTS):
+                if count == num_rows:
+                    return
+                status = 'present' if (s + d) % 5 else 'absent'
+                yield ((f'student{s:05d}', text, num, '09:00:00', status) if with_day
+                       else (f'student{s:05d}', text, '09:00:00', status))
+                count += 1
+
+    # No ANALYZE afterwards: the app never re-analyzes, so the timings must
+    # not depend on fresh statistics
+    database.executemany(f'INSERT INTO attendance ({columns}) VALUES ({marks})', rows())
+    return start + timedelta(days=days // 2)
+
+
+def timed(database, sql, params, repeat):
+    with database.connection() as conn:
+        conn.execute(sql, params).fetchall()  # warm the page cache
+        start = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(sql, params).fetchall()
+        return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for num_rows in args.rows:
+            old = Database(os.path.join(tmp, f'old_{num_rows}.db'))
+            apply_migrations(old, MIGRATIONS[:2])
+            new = Database(os.path.join(tmp, f'new_{num_rows}.db'))
+            apply_migrations(new)
+
+            t0 = time.perf_counter()
+            probe = populate(old, num_rows, with_day=False)
+            populate(new, num_rows, with_day=True)
+            print(f'\n{num_rows:,} rows ({STUDENTS} students), loaded in {time.perf_counter() - t0:.1f} s')
+
+            text, num = probe.isoformat(), int(probe.strftime('%Y%m%d'))
+            week_start = probe - timedelta(days=7)
+            queries = [
+                ('records for one date',
+                 'SELECT name, date, time, status FROM attendance WHERE date = ?', (text,),
+                 'SELECT name, date, time, status FROM attendance WHERE day = ?', (num,)),
+                ('present count for one date',
+                 "SELECT COUNT(*) FROM attendance WHERE date = ? AND status = 'present'", (text,),
+                 "SELECT COUNT(*) FROM attendance WHERE day = ? AND status = 'present'", (num,)),
+                ('one student, last week',
+                 'SELECT date, status FROM attendance WHERE name = ? AND date >= ?',
+                 ('student00042', week_start.isoformat()),
+                 'SELECT date, status FROM attendance WHERE name = ? AND day >= ?',
+                 ('student00042', int(week_start.strftime('%Y%m%d')))),
+            ]
+            print(f'  {"query":<28} {"v2 ms":>10} {"indexed ms":>11} {"speedup":>8}')
+            for label, old_sql, old_params, new_sql, new_params in queries:
+                old_ms = timed(old, old_sql, old_params, args.repeat)
+                new_ms = timed(new, new_sql, new_params, args.repeat)
+                print(f'  {label:<28} {old_ms:>10.3f} {new_ms:>11.3f} {old_ms / new_ms:>7.1f}x')
+            old.close_all()
+            new.close_all()
+
+
+if __name__ == '__main__':
+    main()
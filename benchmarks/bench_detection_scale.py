@@ -0,0 +1,83 @@
+"""
+Detection time and recall of the fast detector across detection resolutions.
+
+Runs the fast stage of face_utils.detect_faces (FAST_DETECTOR, HOG by
+default) on every image in a directory, at full resolution and downscaled to
+each target short side, and reports the mean detection time and the recall
+against the reference boxes (IoU >= 0.5). The reference is full-resolution
+detection with the same detector, or the CNN detector with --reference cnn.
+Example:
+
+    python benchmarks/bench_detection_scale.py photos/ --short-side 240 360 480 720
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from face_tracker import iou_matrix
+from face_utils import detect_faces, downscale_for_detection
+
+MATCH_IOU = 0.5
+
+
+def load_images(path):
+    images = []
+    for fn in sorted(os.listdir(path)):
+        if os.path.splitext(fn)[1].lower() in ('.jpg', '.jpeg', '.png'):
+            img = cv2.imread(os.path.join(path, fn))
+            if img is not None:
+                images.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    return images
+
+
+def recall(found, reference):
+    if not reference:
+        return None
+    if not found:
+        return 0.0
+    return float(np.mean(iou_matrix(reference, found).max(axis=1) >= MATCH_IOU))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('images', help='directory of test photos')
+    parser.add_argument('--short-side', type=int, nargs='+', default=[240, 360, 480, 720])
+    parser.add_argument('--reference', choices=['full', 'cnn'], default='full')
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if not images:
+        parser.error(f'no images found in {args.images}')
+    if args.reference == 'cnn':
+        references = [detect_faces(rgb, 'cnn') for rgb in images]
+    else:
+        references = [detect_faces(rgb, 'fast', small=rgb, scale=1.0) for rgb in images]
+    faces = sum(map(len, references))
+    print(f'{len(images)} images, {faces} reference faces ({args.reference})')
+
+    print(f'  {"short side":>10} {"ms/image":>9} {"recall":>7}')
+    for short_side in [None] + args.short_side:
+        elapsed, recalls = 0.0, []
+        for rgb, reference in zip(images, references):
+            start = time.perf_counter()
+            if short_side:
+                small, scale = downscale_for_detection(rgb, short_side)
+            else:
+                small, scale = rgb, 1.0
+            found = detect_faces(rgb, 'fast', small=small, scale=scale)
+            elapsed += time.perf_counter() - start
+            r = recall(found, reference)
+            if r is not None:
+                recalls.append(r)
+        label = short_side or 'full'
+        mean_recall = f'{np.mean(recalls):.3f}' if recalls else 'n/a'
+        print(f'  {label:>10} {elapsed / len(images) * 1000:>9.1f} {mean_recall:>7}')
+
+
+if __name__ == '__main__':
+    main()
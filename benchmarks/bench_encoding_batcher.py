@@ -0,0 +1,78 @@
+"""
+Throughput vs. p99 latency of batched face encoding.
+
+Many client threads encode the faces of the same photo concurrently, as
+simultaneous /attendance requests would, once without batching and then
+with each max-batch-size / max-wait setting. Needs a photo with at least one
+face. Example:
+
+    python benchmarks/bench_encoding_batcher.py photo.jpg --clients 16 --batch 4 16 32 --wait 2 5 10
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import cv2
+import face_recognition
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from encoding_batcher import EncodingBatcher
+
+
+def run(batcher, rgb, locations, clients, requests_per_client):
+    latencies = []
+    lock = threading.Lock()
+
+    def client():
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            batcher.encode(rgb, locations)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.perf_counter() - start
+    faces = clients * requests_per_client * len(locations)
+    return faces / total, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('image')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=20, help='requests per client')
+    parser.add_argument('--batch', type=int, nargs='+', default=[4, 16, 32])
+    parser.add_argument('--wait', type=float, nargs='+', default=[2, 5, 10], help='max wait in ms')
+    args = parser.parse_args()
+
+    img = cv2.imread(args.image)
+    if img is None:
+        parser.error(f'could not read {args.image}')
+    rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    locations = face_recognition.face_locations(rgb)
+    if not locations:
+        parser.error('no face found in the image')
+    print(f'{len(locations)} face(s) per request, {args.clients} clients')
+
+    print(f'  {"batch":>5} {"wait ms":>7} {"faces/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"avg batch":>9}')
+    settings = [(1, 0)] + [(b, w) for b in args.batch for w in args.wait]
+    for max_batch, wait in settings:
+        batcher = EncodingBatcher(max_batch_size=max_batch, max_wait_ms=wait)
+        batcher.encode(rgb, locations)  # warm up
+        rate, p50, p99 = run(batcher, rgb, locations, args.clients, args.requests)
+        avg = batcher.stats['faces'] / batcher.stats['batches'] if batcher.stats['batches'] else 1
+        label = 'off' if max_batch == 1 else max_batch
+        print(f'  {label:>5} {wait:>7g} {rate:>8.1f} {p50:>8.1f} {p99:>8.1f} {avg:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
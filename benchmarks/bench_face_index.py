@@ -0,0 +1,72 @@
+"""
+Recall vs. latency of the IVF face index against exact brute-force search.
+
+Uses synthetic 128-d encodings shaped like face_recognition output (gallery
+entries ~0.9 apart, probes ~0.35 from their identity) so it runs without
+enrolment photos. Example:
+
+    python benchmarks/bench_face_index.py --gallery 50000 --nprobe 1 4 8 16 32
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from face_index import ENCODING_DIM, BruteForceIndex, IVFIndex
+
+
+def make_data(gallery_size, num_probes, seed=0):
+    rng = np.random.default_rng(seed)
+    # A few hundred "demographic" clusters so the data is not uniformly spread
+    centers = rng.normal(0, 0.07, (max(1, gallery_size // 200), ENCODING_DIM))
+    gallery = (centers[rng.integers(len(centers), size=gallery_size)]
+               + rng.normal(0, 0.055, (gallery_size, ENCODING_DIM))).astype(np.float32)
+    truth = rng.integers(gallery_size, size=num_probes)
+    probes = (gallery[truth] + rng.normal(0, 0.03, (num_probes, ENCODING_DIM))).astype(np.float32)
+    return gallery, probes, truth
+
+
+def time_search(index, probes, k, batch):
+    start = time.perf_counter()
+    rows = []
+    for i in range(0, len(probes), batch):
+        r, _ = index.search(probes[i:i + batch], k)
+        rows.append(r)
+    elapsed = time.perf_counter() - start
+    return np.vstack(rows), elapsed / len(probes) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--gallery', type=int, nargs='+', default=[2000, 20000, 50000])
+    parser.add_argument('--probes', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=30, help='probes per search call (faces per frame)')
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    for size in args.gallery:
+        gallery, probes, truth = make_data(size, args.probes)
+        names = [str(i) for i in range(size)]
+        exact = BruteForceIndex().build(names, gallery)
+        exact_rows, exact_ms = time_search(exact, probes, args.k, args.batch)
+        print(f'\ngallery={size}  exact: {exact_ms:.3f} ms/probe  '
+              f'recall@1 vs truth={np.mean(exact_rows[:, 0] == truth):.4f}')
+
+        start = time.perf_counter()
+        ivf = IVFIndex().build(names, gallery)
+        print(f'  IVF build: nlist={len(ivf.centroids)} in {time.perf_counter() - start:.2f} s')
+        print(f'  {"nprobe":>6} {"ms/probe":>9} {"speedup":>8} {"recall@1":>9} {"recall@k":>9}')
+        for nprobe in args.nprobe:
+            ivf.nprobe = nprobe
+            rows, ms = time_search(ivf, probes, args.k, args.batch)
+            recall1 = np.mean(rows[:, 0] == exact_rows[:, 0])
+            recallk = np.mean([len(set(a) & set(b)) / args.k for a, b in zip(rows, exact_rows)])
+            print(f'  {nprobe:>6} {ms:>9.3f} {exact_ms / ms:>7.1f}x {recall1:>9.4f} {recallk:>9.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Recognition throughput of the worker pool for different worker counts.
+
+Sends the same frame sequence from many client threads at once, as several
+kiosks would, and reports requests per second for each pool size. Needs a
+photo with at least one face; the gallery is whatever database.db holds.
+Example:
+
+    python benchmarks/bench_recognition_service.py photo.jpg --workers 1 2 4 --clients 8
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from recognition_service import RecognitionService, ServiceBusy
+
+
+def run(service, imgs, clients, requests_per_client):
+    busy = []
+
+    def client():
+        for _ in range(requests_per_client):
+            while True:
+                try:
+                    service.recognize_sequence(imgs)
+                    break
+                except ServiceBusy:
+                    busy.append(1)
+                    time.sleep(0.01)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return clients * requests_per_client / (time.perf_counter() - start), len(busy)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('image')
+    parser.add_argument('--frames', type=int, default=5, help='frames per request')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=5, help='requests per client')
+    args = parser.parse_args()
+
+    img = cv2.imread(args.image)
+    if img is None:
+        parser.error(f'could not read {args.image}')
+    imgs = [img] * args.frames
+
+    print(f'{"workers":>7} {"req/s":>8} {"scaling":>8} {"429s":>6}')
+    base = None
+    for workers in args.workers:
+        service = RecognitionService(workers=workers, max_pending=args.clients)
+        service.start()
+        service.recognize_sequence(imgs)  # wait for a worker to finish loading
+        rate, busy = run(service, imgs, args.clients, args.requests)
+        service.stop()
+        base = base or rate / workers
+        print(f'{workers:>7} {rate:>8.2f} {rate / base:>7.2f}x {busy:>6}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import atexit
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# SQLite data access.
+#
+# Opening a connection per statement is slow and, in rollback-journal mode,
+# makes concurrent readers and writers block each other. Database keeps a pool
+# of open connections: each call checks one out, so a connection is only ever
+# used by one thread at a time, and returns it afterwards. Connections run in
+# WAL mode (readers don't block the writer) with tuned pragmas, and because
+# they stay open sqlite3's per-connection statement cache lets repeated
+# queries skip re-preparing their SQL.
+
+PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',     # safe with WAL, avoids an fsync per commit
+    'PRAGMA cache_size = -16000',      # 16 MB page cache per connection
+    'PRAGMA mmap_size = 268435456',    # memory-map up to 256 MB of the file
+    'PRAGMA temp_store = MEMORY',
+)
+BUSY_TIMEOUT_SECONDS = 10
+STATEMENT_CACHE_SIZE = 256
+MAX_IDLE_CONNECTIONS = 8
+
+
+class Database:
+    def __init__(self, path, max_idle=MAX_IDLE_CONNECTIONS):
+        self.path = path
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._closed = False
+        # WAL is a property of the database file, so set it once up front
+        conn = self._open()
+        conn.execute('PRAGMA journal_mode = WAL')
+        self._release(conn)
+        atexit.register(self.close_all)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _release(self, conn):
+        with self._lock:
+            if not self._closed and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._open()
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        # Commits on success, rolls back on error. immediate=True takes the
+        # write lock up front, for read-then-write sequences.
+        with self.connection() as conn:
+            with conn:
+                if immediate:
+                    conn.execute('BEGIN IMMEDIATE')
+                yield conn
+
+    def execute(self, sql, params=()):
+        # Run one write statement in its own transaction; returns the rowcount
+        with self.transaction() as conn:
+            return conn.execute(sql, params).rowcount
+
+    def executemany(self, sql, seq_of_params):
+        with self.transaction() as conn:
+            return conn.executemany(sql, seq_of_params).rowcount
+
+    def query_all(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def iter_query(self, sql, params=(), batch_size=1000):
+        # Stream rows from a cursor in batches instead of fetching them all;
+        # the connection stays checked out until the generator is exhausted
+        # or closed
+        with self.connection() as conn:
+            cursor = conn.execute(sql, params)
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        return
+                    yield from rows
+            finally:
+                cursor.close()
+
+    def close_all(self):
+        # Shutdown hook: close idle connections and stop pooling new ones
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import cv2
+import face_recognition
+import numpy as np
+
+from db import Database
+from encoding_batcher import encoding_batcher, encode_batch, ENCODING_VERSION
+
+# Content-addressed cache of enrolment embeddings.
+#
+# Registration, the gallery backfill, the legacy importer and example.py's
+# scan of registered_faces all turn the same photos into embeddings over and
+# over: decode, detect, encode. EmbeddingCache keys the result on the SHA-256
+# of the image bytes and keeps it in its own SQLite file: the encoding, the
+# detected box and the 5-point landmarks of the first face, and how many
+# faces were found (None if the image could not be decoded).
+# Entries are tagged with ENCODING_VERSION, so a new encoder misses the cache
+# rather than reusing old embeddings. Once there are more than max_entries,
+# the least recently used ones are evicted.
+#
+# The file is opened on first use, so processes that never enrol (the
+# recognition workers) don't touch it.
+
+EMBEDDING_CACHE_FILE = os.environ.get('EMBEDDING_CACHE_FILE', 'embedding_cache.db')
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 20000))
+CACHE_SCHEMA_VERSION = 2  # a cache file with another schema is simply dropped
+
+
+def image_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _detect(data):
+    # (rgb, face locations) of a JPEG/PNG byte string; (None, None) if it
+    # can't be decoded
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None, None
+    rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return rgb, face_recognition.face_locations(rgb)
+
+
+def _entry(rgb, locations, encoding=None):
+    # {'encoding', 'box', 'landmarks', 'faces'} for the first face; encoding,
+    # box and landmarks are None when there is no face
+    if not locations:
+        return {'encoding': None, 'box': None, 'landmarks': None,
+                'faces': None if locations is None else 0}
+    box = tuple(int(v) for v in locations[0])
+    landmarks = face_recognition.face_landmarks(rgb, [box], model='small')[0]
+    return {
+        'encoding': encoding,
+        'box': box,
+        'landmarks': {part: [[int(x), int(y)] for x, y in points] for part, points in landmarks.items()},
+        'faces': len(locations),
+    }
+
+
+def embed_image(data):
+    # Embedding of the first face in a JPEG/PNG byte string. Encodes through
+    # the shared batcher, so concurrent registrations share a batch.
+    rgb, locations = _detect(data)
+    if not locations:
+        return _entry(rgb, locations)
+    return _entry(rgb, locations, encoding_batcher.encode(rgb, locations[:1])[0])
+
+
+def embed_images(images):
+    # embed_image for many byte strings, encoded in one batched call; for
+    # bulk enrolment workers
+    detected = [_detect(data) for data in images]
+    encodings = encode_batch([rgb for rgb, _ in detected],
+                             [locations[:1] if locations else [] for _, locations in detected])
+    return [_entry(rgb, locations, encs[0] if encs else None)
+            for (rgb, locations), encs in zip(detected, encodings)]
+
+
+class EmbeddingCache:
+    def __init__(self, path=EMBEDDING_CACHE_FILE, max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+                 version=ENCODING_VERSION):
+        self.path = path
+        self.max_entries = max_entries
+        self.version = version
+        self._db = None
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _database(self):
+        with self._lock:
+            if self._db is None:
+                db = Database(self.path)
+                with db.transaction() as conn:
+                    if conn.execute('PRAGMA user_version').fetchone()[0] != CACHE_SCHEMA_VERSION:
+                        conn.execute('DROP TABLE IF EXISTS embeddings')
+                        conn.execute(f'PRAGMA user_version = {CACHE_SCHEMA_VERSION}')
+                    conn.execute('''
+                        CREATE TABLE IF NOT EXISTS embeddings (
+                            digest TEXT PRIMARY KEY,
+                            encoding_version TEXT NOT NULL,
+                            encoding BLOB,
+                            box TEXT,
+                            landmarks TEXT,
+                            faces INTEGER,
+                            last_used REAL NOT NULL
+                        )
+                    ''')
+                    conn.execute('CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)')
+                self._db = db
+            return self._db
+
+    def get(self, digest):
+        # The cached entry for digest, or None on a miss
+        db = self._database()
+        row = db.query_one('''
+            SELECT encoding, box, landmarks, faces FROM embeddings WHERE digest = ? AND encoding_version = ?
+        ''', (digest, self.version))
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        db.execute('UPDATE embeddings SET last_used = ? WHERE digest = ?', (time.time(), digest))
+        encoding, box, landmarks, faces = row
+        return {
+            'encoding': np.frombuffer(encoding, dtype=np.float32) if encoding is not None else None,
+            'box': tuple(json.loads(box)) if box is not None else None,
+            'landmarks': json.loads(landmarks) if landmarks is not None else None,
+            'faces': faces,
+        }
+
+    def put(self, digest, entry):
+        encoding = entry['encoding']
+        with self._database().transaction() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO embeddings (digest, encoding_version, encoding, box, landmarks, faces, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (digest, self.version,
+                  np.asarray(encoding, dtype=np.float32).tobytes() if encoding is not None else None,
+                  json.dumps(entry['box']) if entry['box'] is not None else None,
+                  json.dumps(entry['landmarks']) if entry['landmarks'] is not None else None,
+                  entry['faces'], time.time()))
+            evicted = conn.execute('''
+                DELETE FROM embeddings WHERE digest IN (
+                    SELECT digest FROM embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_entries,)).rowcount
+        self.stats['evictions'] += evicted
+
+    def embedding(self, data):
+        # Cached embed_image(data)
+        digest = image_digest(data)
+        entry = self.get(digest)
+        if entry is None:
+            entry = embed_image(data)
+            self.put(digest, entry)
+        return entry
+
+
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,123 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import dlib
+import numpy as np
+from face_recognition import api as fr_api
+
+# Cross-request batching of face encodings.
+#
+# The ResNet forward pass behind face_recognition.face_encodings is the
+# expensive step and dlib runs it much more efficiently on a batch than one
+# face at a time. EncodingBatcher collects the faces from every thread that
+# asks for encodings within a short window (max_wait_ms, or until
+# max_batch_size faces are waiting), runs one batched compute_face_descriptor
+# call over all of them and hands each caller back its own encodings.
+#
+# Only callers in the same process share a batch: concurrent requests when
+# recognition runs in the web process (RECOGNITION_WORKERS=0), registrations,
+# and the legacy importer.
+#
+# ENCODING_BATCH_SIZE=1 turns batching off and encodes on the calling thread.
+
+ENCODING_BATCH_SIZE = int(os.environ.get('ENCODING_BATCH_SIZE', 16))
+ENCODING_BATCH_WAIT_MS = float(os.environ.get('ENCODING_BATCH_WAIT_MS', 5))
+ENCODING_JITTERS = 1
+
+# Face encodings are stored with the user (and in embedding_cache) tagged
+# with the encoder that produced them; bump the version whenever the model or
+# preprocessing changes so stale encodings get recomputed on the next gallery
+# load.
+ENCODING_VERSION = f'dlib_resnet_v1:rgb:jitter{ENCODING_JITTERS}'
+
+
+def _landmarks(rgb, locations):
+    # 5-point landmarks, as face_recognition.face_encodings(model='small') uses
+    shapes = dlib.full_object_detections()
+    for location in locations:
+        shapes.append(fr_api.pose_predictor_5_point(rgb, fr_api._css_to_rect(location)))
+    return shapes
+
+
+def encode_batch(rgbs, locations_list, num_jitters=ENCODING_JITTERS):
+    # Encodings for several images at once: one list of float32 arrays per
+    # image, in the order of its locations
+    images, shapes, slots = [], [], []
+    for i, (rgb, locations) in enumerate(zip(rgbs, locations_list)):
+        if locations:
+            images.append(rgb)
+            shapes.append(_landmarks(rgb, locations))
+            slots.append(i)
+    out = [[] for _ in rgbs]
+    if images:
+        descriptors = fr_api.face_encoder.compute_face_descriptor(images, shapes, num_jitters)
+        for i, faces in zip(slots, descriptors):
+            out[i] = [np.asarray(d, dtype=np.float32) for d in faces]
+    return out
+
+
+class EncodingBatcher:
+    def __init__(self, max_batch_size=ENCODING_BATCH_SIZE, max_wait_ms=ENCODING_BATCH_WAIT_MS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {'batches': 0, 'faces': 0}
+
+    def encode(self, rgb, locations):
+        # Encodings for the faces at locations in rgb, one float32 array each
+        if not locations:
+            return []
+        if self.max_batch_size <= 1:
+            return encode_batch([rgb], [locations])[0]
+        self._ensure_thread()
+        future = Future()
+        self._queue.put((rgb, list(locations), future))
+        return future.result()
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='encoding-batcher', daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        # Block for the first request, then gather more until the batch is
+        # full or the wait window closes
+        batch = [self._queue.get()]
+        faces = len(batch[0][1])
+        deadline = time.perf_counter() + self.max_wait
+        while faces < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            faces += len(item[1])
+        return batch, faces
+
+    def _run(self):
+        while True:
+            batch, faces = self._collect()
+            try:
+                results = encode_batch([rgb for rgb, _, _ in batch], [locs for _, locs, _ in batch])
+            except Exception as e:
+                logging.error(f"Batched face encoding failed: {e}")
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.stats['batches'] += 1
+            self.stats['faces'] += faces
+            for (_, _, future), encs in zip(batch, results):
+                future.set_result(encs)
+
+
+encoding_batcher = EncodingBatcher()
@@ -0,0 +1,196 @@
+"""
+Bulk enrolment of a whole class from a directory of photos or a CSV manifest.
+
+A manifest has one row per student: name, email, roll number and image path
+(relative to the manifest), optionally followed by a class name; this is
+user_data.csv with an image column added. A directory holds one <name>.jpg
+(or .jpeg / .png) per student, with emails and roll numbers taken from
+--details, a user_data.csv style file, when given.
+
+Images are decoded, detected and encoded across a pool of worker processes
+and every student is written in one transaction through the same storage as
+/register. Images with no face, several faces or that can't be read are
+reported and skipped. Each embedding is saved to the embedding cache as soon
+as it is computed, and students who already have embeddings are skipped
+(unless --include-enrolled, which adds the photos to their embedding sets),
+so an interrupted run picks up where it stopped.
+Running web servers see the new students after a restart. Example:
+
+    python enroll.py class_roster.csv --class-name CS-1A --report failures.csv
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from embedding_cache import embedding_cache, embed_images, image_digest
+from face_utils import ENCODING_VERSION, database, save_users
+from import_legacy_users import read_legacy_csv
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+CHUNK_SIZE = 16  # images per worker task, encoded in one batch
+
+
+def read_manifest(path, class_name=None):
+    # [{name, email, rollno, image, class_name}]; the header row is skipped
+    base = os.path.dirname(os.path.abspath(path))
+    records = []
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 4 or not row[0].strip() or row[0].strip().lower() == 'name':
+                continue
+            records.append({
+                'name': row[0].strip(),
+                'email': row[1].strip(),
+                'rollno': row[2].strip(),
+                'image': os.path.join(base, row[3].strip()),
+                'class_name': (row[4].strip() if len(row) > 4 and row[4].strip() else class_name),
+            })
+    return records
+
+
+def read_directory(path, details_csv=None, class_name=None):
+    # One record per <name>.<ext> image, details from a user_data.csv style file
+    details = read_legacy_csv(details_csv) if details_csv else {}
+    records = []
+    for fn in sorted(os.listdir(path)):
+        name, ext = os.path.splitext(fn)
+        if ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        email, rollno = details.get(name, ('', ''))
+        records.append({'name': name, 'email': email, 'rollno': rollno,
+                        'image': os.path.join(path, fn), 'class_name': class_name})
+    return records
+
+
+def _embed_chunk(paths):
+    # Worker task: [(digest, entry)] for each image file
+    images = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            images.append(f.read())
+    return [(image_digest(data), entry) for data, entry in zip(images, embed_images(images))]
+
+
+def _failure_reason(entry):
+    if entry['faces'] is None:
+        return 'could not decode image'
+    if entry['faces'] == 0:
+        return 'no face found'
+    if entry['faces'] > 1:
+        return f"{entry['faces']} faces found"
+    return None
+
+
+def embed_records(records, workers, chunk_size=CHUNK_SIZE, progress=print):
+    # Sets record['digest'] and returns ({digest: entry}, [(record, reason)]).
+    # Cached images are not re-encoded; new embeddings are cached as each
+    # chunk finishes.
+    entries, failures, pending = {}, [], {}
+    for record in records:
+        try:
+            with open(record['image'], 'rb') as f:
+                digest = image_digest(f.read())
+        except OSError as e:
+            failures.append((record, f'cannot read image: {e.strerror}'))
+            continue
+        record['digest'] = digest
+        if digest in entries or digest in pending:
+            continue
+        entry = embedding_cache.get(digest)
+        if entry is not None:
+            entries[digest] = entry
+        else:
+            pending[digest] = record['image']
+    progress(f'{len(entries)} image(s) cached, {len(pending)} to encode')
+
+    paths = list(pending.values())
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    if chunks:
+        done, start = 0, time.perf_counter()
+        # spawn, not fork: the parent holds open sqlite connections
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [pool.submit(_embed_chunk, chunk) for chunk in chunks]
+            for future in as_completed(futures):
+                for digest, entry in future.result():
+                    embedding_cache.put(digest, entry)
+                    entries[digest] = entry
+                    done += 1
+                rate = done / (time.perf_counter() - start)
+                progress(f'encoded {done}/{len(paths)} ({rate:.1f} images/s)')
+
+    for record in records:
+        entry = entries.get(record.get('digest'))
+        if entry is None:
+            continue  # unreadable, already reported
+        reason = _failure_reason(entry)
+        if reason:
+            failures.append((record, reason))
+    return entries, failures
+
+
+def enroll(records, workers=None, include_enrolled=False, progress=print):
+    # Returns counts and the failures as [(record, reason)]
+    skipped = 0
+    if not include_enrolled:
+        enrolled = {name for (name,) in database.query_all(
+            'SELECT DISTINCT name FROM user_embeddings WHERE encoding_version = ?',
+            (ENCODING_VERSION,))}
+        todo = [r for r in records if r['name'] not in enrolled]
+        skipped = len(records) - len(todo)
+        records = todo
+
+    entries, failures = embed_records(records, workers or os.cpu_count() or 1, progress=progress)
+    failed = {id(record) for record, _ in failures}
+    ok = [r for r in records if id(r) not in failed]
+
+    def rows():
+        # Image bytes are read again here so the whole class isn't held in memory
+        for record in ok:
+            with open(record['image'], 'rb') as f:
+                face_image = f.read()
+            yield (record['name'], record['email'], record['rollno'], face_image,
+                   entries[record['digest']]['encoding'], record['class_name'])
+
+    enrolled_count = save_users(rows())
+    return {'enrolled': enrolled_count, 'failed': len(failures), 'skipped': skipped}, failures
+
+
+def write_report(path, failures):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'image', 'reason'])
+        for record, reason in failures:
+            writer.writerow([record['name'], record['image'], reason])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('source', help='CSV manifest or directory of <name>.jpg photos')
+    parser.add_argument('--details', help='user_data.csv style file with emails and roll numbers (directory mode)')
+    parser.add_argument('--class-name', help='class for students without one in the manifest')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--include-enrolled', action='store_true',
+                        help='also add photos for students who already have embeddings')
+    parser.add_argument('--report', help='write failures to this CSV file')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.source):
+        records = read_directory(args.source, args.details, args.class_name)
+    else:
+        records = read_manifest(args.source, args.class_name)
+    start = time.perf_counter()
+    counts, failures = enroll(records, args.workers, args.include_enrolled)
+    for record, reason in failures:
+        print(f"  {record['name']} ({record['image']}): {reason}")
+    if args.report:
+        write_report(args.report, failures)
+    print(f"Enrolled {counts['enrolled']} student(s), {counts['failed']} failed, "
+          f"skipped {counts['skipped']} already enrolled in {time.perf_counter() - start:.0f}s")
+    database.close_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,8 @@ from tkinter import simpledialog, messagebox
 import cv2, os, numpy as np, face_recognition
 import mediapipe as mp
 from datetime import datetime
+from face_tracker import FaceTracker, landmarks_box
+from embedding_cache import embedding_cache
 
 # ——— setup ———
 if not os.path.exists('registered_faces'):
@@ -18,11 +20,15 @@ def mark_attendance(name):
     with open(attendance_file, 'a') as f:
         f.write(f'{name},{now}\n')
 
+# photos are only encoded the first time they are seen; later launches read
+# the embeddings back from the cache (keyed by the file's contents)
 def load_registered_faces():
     encs, names = [], []
     for fn in os.listdir('registered_faces'):
-        img = face_recognition.load_image_file(f'registered_faces/{fn}')
-        encs.append(face_recognition.face_encodings(img)[0])
+        with open(f'registered_faces/{fn}', 'rb') as f:
+            enc = embedding_cache.embedding(f.read())['encoding']
+        if enc is None: continue
+        encs.append(enc)
         names.append(os.path.splitext(fn)[0])
     return encs, names
 
@@ -58,66 +64,78 @@ def detect_faces():
     known_encs, known_names = load_registered_faces()
     cap = cv2.VideoCapture(0)
 
+    # faces are tracked between frames: detection every few frames, optical
+    # flow in between, and a face is only encoded while its identity is unsure
+    tracker = FaceTracker()
+    blinked = set()   # track ids that blinked
+    marked = set()    # track ids already marked
+
     with mp_fd.FaceDetection(model_selection=0, min_detection_confidence=0.5) as fd, \
-         mp_fm.FaceMesh(max_num_faces=1,
+         mp_fm.FaceMesh(max_num_faces=5,
                         refine_landmarks=True,
                         min_detection_confidence=0.5,
                         min_tracking_confidence=0.5) as fm:
 
-        blinked = False
         EAR_THRESH = 0.25
 
         while True:
             ret, frame = cap.read()
             if not ret: break
             rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-            # 1) face detection
-            fd_res = fd.process(rgb)
-            # 2) face mesh for liveness
-            fm_res = fm.process(rgb)
-
-            if fm_res.multi_face_landmarks:
-                lm = fm_res.multi_face_landmarks[0].landmark
-                leftEAR  = eye_aspect_ratio(lm, LEFT_EYE_IDX)
-                rightEAR = eye_aspect_ratio(lm, RIGHT_EYE_IDX)
-                ear = (leftEAR + rightEAR) / 2.0
-
-                if ear < EAR_THRESH:
-                    blinked = True
-                    cv2.putText(frame, "Blink detected ✅", (10,30),
-                                cv2.FONT_HERSHEY_SIMPLEX, 1, (0,255,0), 2)
-                else:
-                    cv2.putText(frame, "Please blink to verify liveness", (10,30),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0,0,255), 2)
-
-            # only if a face is detected and liveness confirmed…
-            if fd_res.detections and blinked:
-                for det in fd_res.detections:
+            ih, iw, _ = frame.shape
+            tracker.next_frame(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+
+            # 1) face detection, on the tracker's cadence
+            if tracker.due_for_detection():
+                fd_res = fd.process(rgb)
+                boxes = []
+                for det in fd_res.detections or []:
                     b = det.location_data.relative_bounding_box
-                    ih, iw, _ = frame.shape
                     x, y = int(b.xmin*iw), int(b.ymin*ih)
                     w, h = int(b.width*iw), int(b.height*ih)
-                    top, right, bottom, left = y, x+w, y+h, x
+                    boxes.append((max(y, 0), min(x+w, iw), min(y+h, ih), max(x, 0)))
 
-                    # 3) recognition
+                # 2) recognition, only for new or uncertain tracks
+                to_encode = tracker.update(boxes)
+                if to_encode and known_encs:
                     encs = face_recognition.face_encodings(
                         rgb,
-                        known_face_locations=[(top,right,bottom,left)],
+                        known_face_locations=[t.box for t in to_encode],
                         num_jitters=1
                     )
-                    if encs:
-                        idx = np.argmin(face_recognition.face_distance(known_encs, encs[0]))
-                        if face_recognition.compare_faces(known_encs, encs[0])[idx]:
-                            name = known_names[idx]
-                            mark_attendance(name)
-                            cv2.putText(frame, name, (x, y-10),
-                                        cv2.FONT_HERSHEY_SIMPLEX, 1, (0,255,0), 2)
-                        else:
-                            cv2.putText(frame, "Unknown", (x, y-10),
-                                        cv2.FONT_HERSHEY_SIMPLEX, 1, (0,0,255), 2)
-
-                    cv2.rectangle(frame, (x,y), (x+w,y+h), (255,0,0), 2)
+                    for track, enc in zip(to_encode, encs):
+                        dists = face_recognition.face_distance(known_encs, enc)
+                        idx = np.argmin(dists)
+                        track.set_match({'name': known_names[idx] if dists[idx] <= 0.6 else None,
+                                         'distance': float(dists[idx])})
+
+            # 3) face mesh for liveness, paired with tracks by position
+            fm_res = fm.process(rgb)
+            lms = fm_res.multi_face_landmarks or []
+            for track, j in tracker.assign([landmarks_box(lm, iw, ih) for lm in lms]).items():
+                lm = lms[j].landmark
+                leftEAR  = eye_aspect_ratio(lm, LEFT_EYE_IDX)
+                rightEAR = eye_aspect_ratio(lm, RIGHT_EYE_IDX)
+                if (leftEAR + rightEAR) / 2.0 < EAR_THRESH:
+                    blinked.add(track.id)
+
+            # only if liveness is confirmed for that face…
+            for track in tracker.tracks:
+                top, right, bottom, left = track.box
+                if track.id not in blinked:
+                    cv2.putText(frame, "Please blink to verify liveness", (left, top-10),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0,0,255), 2)
+                elif track.name:
+                    if track.id not in marked:
+                        mark_attendance(track.name)
+                        marked.add(track.id)
+                    cv2.putText(frame, track.name, (left, top-10),
+                                cv2.FONT_HERSHEY_SIMPLEX, 1, (0,255,0), 2)
+                else:
+                    cv2.putText(frame, "Unknown", (left, top-10),
+                                cv2.FONT_HERSHEY_SIMPLEX, 1, (0,0,255), 2)
+
+                cv2.rectangle(frame, (left,top), (right,bottom), (255,0,0), 2)
 
             cv2.imshow("Attendance (Esc to exit)", frame)
             if cv2.waitKey(5) & 0xFF == 27:
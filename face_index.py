@@ -0,0 +1,330 @@
+import os
+import threading
+import numpy as np
+
+# Gallery index used by face_utils.match_faces.
+#
+# BruteForceIndex compares every probe against every enrolled encoding and is
+# the right choice for a single class or department. IVFIndex partitions the
+# gallery with k-means and only scans the few partitions closest to each
+# probe, which keeps matching fast for campus-sized galleries. Both support
+# incremental add/remove and can be saved to / loaded from an .npz file.
+
+ENCODING_DIM = 128
+
+
+def face_distance_matrix(probe_encs, known_encs):
+    # All pairwise euclidean distances (P x N) in one matrix product, using
+    # |p - g|^2 = |p|^2 + |g|^2 - 2 p.g
+    probes = np.asarray(probe_encs, dtype=np.float32).reshape(-1, ENCODING_DIM)
+    gallery = np.asarray(known_encs, dtype=np.float32).reshape(-1, ENCODING_DIM)
+    sq = (np.einsum('ij,ij->i', probes, probes)[:, None]
+          + np.einsum('ij,ij->i', gallery, gallery)[None, :]
+          - 2.0 * (probes @ gallery.T))
+    np.maximum(sq, 0.0, out=sq)
+    return np.sqrt(sq, out=sq)
+
+
+def _top_k(dists, k):
+    # Indices and values of the k smallest entries per row, sorted ascending
+    k = min(k, dists.shape[1])
+    if k < dists.shape[1]:
+        idx = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.tile(np.arange(dists.shape[1]), (dists.shape[0], 1))
+    vals = np.take_along_axis(dists, idx, axis=1)
+    order = np.argsort(vals, axis=1)
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(vals, order, axis=1)
+
+
+class BruteForceIndex:
+    """Exact nearest-neighbour search over all enrolled encodings."""
+
+    kind = 'exact'
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.names = []
+        self._rows = {}
+        self._buf = np.empty((16, ENCODING_DIM), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def encodings(self):
+        return self._buf[:len(self.names)]
+
+    @property
+    def nbytes(self):
+        # Memory held by the encoding buffer (including spare capacity)
+        return self._buf.nbytes
+
+    def build(self, names, encs):
+        with self.lock:
+            encs = np.asarray(encs, dtype=np.float32).reshape(-1, ENCODING_DIM)
+            self.names = list(names)
+            self._rows = {name: i for i, name in enumerate(self.names)}
+            self._buf = np.empty((max(16, 2 * len(self.names)), ENCODING_DIM), dtype=np.float32)
+            self._buf[:len(self.names)] = encs
+            self._on_build()
+        return self
+
+    def get(self, name):
+        with self.lock:
+            row = self._rows.get(name)
+            return None if row is None else self._buf[row].copy()
+
+    def add(self, name, enc):
+        enc = np.asarray(enc, dtype=np.float32).reshape(ENCODING_DIM)
+        with self.lock:
+            row = self._rows.get(name)
+            if row is None:
+                row = len(self.names)
+                if row == len(self._buf):
+                    grown = np.empty((2 * len(self._buf), ENCODING_DIM), dtype=np.float32)
+                    grown[:row] = self._buf[:row]
+                    self._buf = grown
+                self.names.append(name)
+                self._rows[name] = row
+                self._buf[row] = enc
+                self._on_add(row)
+            else:
+                self._on_remove(row)
+                self._buf[row] = enc
+                self._on_add(row)
+
+    def remove(self, name):
+        with self.lock:
+            row = self._rows.pop(name, None)
+            if row is None:
+                return False
+            self._on_remove(row)
+            # Move the last row into the freed slot to keep storage contiguous
+            last = len(self.names) - 1
+            if row != last:
+                last_name = self.names[last]
+                self._on_remove(last)
+                self._buf[row] = self._buf[last]
+                self.names[row] = last_name
+                self._rows[last_name] = row
+                self.names.pop()
+                self._on_add(row)
+            else:
+                self.names.pop()
+            return True
+
+    def search(self, probe_encs, k=1):
+        """
+        Returns (rows, dists), both (P x k). Rows are gallery row numbers
+        (-1 where fewer than k candidates exist); use self.names to map them.
+        """
+        probes = np.asarray(probe_encs, dtype=np.float32).reshape(-1, ENCODING_DIM)
+        rows = np.full((len(probes), k), -1, dtype=np.int64)
+        dists = np.full((len(probes), k), np.inf, dtype=np.float32)
+        with self.lock:
+            if not self.names or not len(probes):
+                return rows, dists
+            self._search(probes, k, rows, dists)
+        return rows, dists
+
+    def _search(self, probes, k, rows, dists):
+        idx, vals = _top_k(face_distance_matrix(probes, self.encodings), k)
+        rows[:, :idx.shape[1]] = idx
+        dists[:, :idx.shape[1]] = vals
+
+    # Hooks for partitioned subclasses
+    def _on_build(self):
+        pass
+
+    def _on_add(self, row):
+        pass
+
+    def _on_remove(self, row):
+        pass
+
+    def _extra_state(self):
+        return {}
+
+    def _load_extra_state(self, data):
+        pass
+
+    def needs_rebuild(self):
+        return False
+
+    def save(self, path, version=''):
+        # Written to a temporary file and renamed over path, so a save cut
+        # short (e.g. by a shutdown) never leaves a truncated index behind
+        tmp_path = f'{path}.tmp'
+        with self.lock:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, kind=self.kind, version=version,
+                         names=np.array(self.names, dtype=str),
+                         encodings=self.encodings, **self._extra_state())
+        os.replace(tmp_path, path)
+
+
+class IVFIndex(BruteForceIndex):
+    """
+    Inverted-file index: k-means centroids split the gallery into nlist
+    partitions and a search only scans the nprobe partitions nearest to each
+    probe. Recall/latency is traded off with nprobe; see
+    benchmarks/bench_face_index.py.
+    """
+
+    kind = 'ivf'
+
+    def __init__(self, nlist=None, nprobe=8, train_iters=15, seed=0):
+        super().__init__()
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_iters = train_iters
+        self.seed = seed
+        self.centroids = np.empty((0, ENCODING_DIM), dtype=np.float32)
+        self._assign = np.empty(0, dtype=np.int64)
+        self._lists = []
+        self._list_arrays = {}
+        self._trained_size = 0
+
+    def _on_build(self):
+        n = len(self.names)
+        nlist = self.nlist or max(1, int(4 * np.sqrt(n)))
+        self.centroids = kmeans(self.encodings, min(nlist, max(n, 1)),
+                                iters=self.train_iters, seed=self.seed)
+        self._trained_size = n
+        self._assign = np.empty(len(self._buf), dtype=np.int64)
+        self._assign[:n] = _nearest(self.encodings, self.centroids) if n else 0
+        self._rebuild_lists()
+
+    def _rebuild_lists(self):
+        n = len(self.names)
+        self._lists = [set() for _ in range(len(self.centroids))]
+        self._list_arrays = {}
+        for row, c in enumerate(self._assign[:n]):
+            self._lists[c].add(row)
+
+    def _list_array(self, c):
+        # Row numbers of partition c, cached until the partition changes
+        arr = self._list_arrays.get(c)
+        if arr is None:
+            arr = np.fromiter(self._lists[c], dtype=np.int64, count=len(self._lists[c]))
+            self._list_arrays[c] = arr
+        return arr
+
+    def _on_add(self, row):
+        if not len(self.centroids):
+            self.centroids = self._buf[row:row + 1].copy()
+            self._lists = [set()]
+        if len(self._assign) < len(self._buf):
+            grown = np.empty(len(self._buf), dtype=np.int64)
+            grown[:len(self._assign)] = self._assign
+            self._assign = grown
+        c = int(_nearest(self._buf[row:row + 1], self.centroids)[0])
+        self._assign[row] = c
+        self._lists[c].add(row)
+        self._list_arrays.pop(c, None)
+
+    def _on_remove(self, row):
+        c = int(self._assign[row])
+        self._lists[c].discard(row)
+        self._list_arrays.pop(c, None)
+
+    @property
+    def nbytes(self):
+        return super().nbytes + self.centroids.nbytes + self._assign.nbytes
+
+    def needs_rebuild(self):
+        # Centroids trained on a much smaller gallery partition poorly
+        return len(self.names) > 2 * max(self._trained_size, 1000)
+
+    def _search(self, probes, k, rows, dists):
+        # Scan the union of every probe's nprobe nearest partitions with one
+        # distance matrix, masking out partitions a probe did not select
+        nprobe = min(self.nprobe, len(self.centroids))
+        probe_lists, _ = _top_k(face_distance_matrix(probes, self.centroids), nprobe)
+        selected = np.unique(probe_lists)
+        cand = np.concatenate([self._list_array(c) for c in selected])
+        if not len(cand):
+            return
+        allowed = np.zeros((len(probes), len(self.centroids)), dtype=bool)
+        np.put_along_axis(allowed, probe_lists, True, axis=1)
+        d = face_distance_matrix(probes, self.encodings[cand])
+        d[~allowed[:, self._assign[cand]]] = np.inf
+        idx, vals = _top_k(d, k)
+        found = np.isfinite(vals)
+        rows[:, :idx.shape[1]] = np.where(found, cand[idx], -1)
+        dists[:, :idx.shape[1]] = vals
+
+    def _extra_state(self):
+        return {'centroids': self.centroids,
+                'assign': self._assign[:len(self.names)],
+                'params': np.array([self.nlist or 0, self.nprobe, self._trained_size])}
+
+    def _load_extra_state(self, data):
+        nlist, self.nprobe, self._trained_size = (int(v) for v in data['params'])
+        self.nlist = nlist or None
+        self.centroids = data['centroids'].astype(np.float32)
+        self._assign = np.empty(len(self._buf), dtype=np.int64)
+        self._assign[:len(self.names)] = data['assign']
+        self._rebuild_lists()
+
+
+def _nearest(encs, centroids, chunk=8192):
+    out = np.empty(len(encs), dtype=np.int64)
+    for start in range(0, len(encs), chunk):
+        d = face_distance_matrix(encs[start:start + chunk], centroids)
+        out[start:start + chunk] = np.argmin(d, axis=1)
+    return out
+
+
+def kmeans(encs, k, iters=15, seed=0, sample_per_centroid=256):
+    # Lloyd's k-means on a random sample of the gallery
+    rng = np.random.default_rng(seed)
+    n = len(encs)
+    if n == 0:
+        return np.empty((0, ENCODING_DIM), dtype=np.float32)
+    sample = encs
+    if n > k * sample_per_centroid:
+        sample = encs[rng.choice(n, k * sample_per_centroid, replace=False)]
+    centroids = sample[rng.choice(len(sample), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = _nearest(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Re-seed empty partitions from random samples
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), len(empty))]
+    return centroids
+
+
+def create_index(num_encodings, ann_threshold, nprobe=8):
+    if num_encodings >= ann_threshold:
+        return IVFIndex(nprobe=nprobe)
+    return BruteForceIndex()
+
+
+def load_index(path, version=''):
+    # Returns the saved index, or None if it is missing, unreadable or from
+    # another encoder; the caller then rebuilds it
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['version']) != version:
+                return None
+            kind = str(data['kind'])
+            index = IVFIndex() if kind == IVFIndex.kind else BruteForceIndex()
+            names = data['names'].tolist()
+            encs = data['encodings']
+            # Restore storage without retraining partitions
+            index.names = list(names)
+            index._rows = {name: i for i, name in enumerate(index.names)}
+            index._buf = np.empty((max(16, 2 * len(names)), ENCODING_DIM), dtype=np.float32)
+            index._buf[:len(names)] = encs
+            index._load_extra_state(data)
+            return index
+    except Exception:
+        # Missing, truncated or corrupt (BadZipFile, EOFError, ...)
+        return None
@@ -0,0 +1,195 @@
+import itertools
+
+import cv2
+import numpy as np
+
+# Face tracking across frames.
+#
+# Detecting and encoding every face in every frame is the expensive part of
+# recognition. FaceTracker keeps one Track per face with a stable id: boxes
+# from the detector are associated with existing tracks by IoU (falling back
+# to centroid distance for fast movers), and between detections the boxes
+# are either held or moved with sparse optical flow. A track only needs
+# encoding when it is new or its identity is still uncertain, and the
+# detector runs every redetect_every frames instead of on every frame.
+# Long-lived trackers (live sessions) can pass reverify_every to re-encode
+# settled tracks every few detections as well, in case someone else has
+# taken a face's place.
+#
+# The same association is used to pair MediaPipe landmark sets with tracks,
+# so a face's eye measurements can't be credited to another face when the
+# two libraries list faces in different orders.
+#
+# Boxes are (top, right, bottom, left) in pixels, as face_recognition uses.
+
+REDETECT_EVERY = 5
+MIN_IOU = 0.3
+MAX_CENTROID_SHIFT = 0.5   # of the track's box size, for the centroid fallback
+MAX_MISSES = 2             # detections a track may miss before it is dropped
+CONFIDENT_DISTANCE = 0.45  # match distance below which identity is settled
+REVERIFY_EVERY = 3         # detections between identity checks, when enabled
+
+
+def iou_matrix(boxes_a, boxes_b):
+    # Pairwise intersection over union, shape (len(boxes_a), len(boxes_b))
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    top = np.maximum(a[:, None, 0], b[None, :, 0])
+    right = np.minimum(a[:, None, 1], b[None, :, 1])
+    bottom = np.minimum(a[:, None, 2], b[None, :, 2])
+    left = np.maximum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    area_a = (a[:, 1] - a[:, 3]) * (a[:, 2] - a[:, 0])
+    area_b = (b[:, 1] - b[:, 3]) * (b[:, 2] - b[:, 0])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-6), 0.0)
+
+
+def _centers(boxes):
+    b = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    return np.stack([(b[:, 3] + b[:, 1]) / 2, (b[:, 0] + b[:, 2]) / 2], axis=1)
+
+
+def associate(boxes_a, boxes_b, min_iou=MIN_IOU, max_shift=MAX_CENTROID_SHIFT):
+    # Greedy one-to-one matching of boxes_a to boxes_b, best IoU first, then
+    # nearest centroid (within max_shift box sizes) for what is left.
+    # Returns {index in boxes_a: index in boxes_b}.
+    if len(boxes_a) == 0 or len(boxes_b) == 0:
+        return {}
+    pairs = {}
+    ious = iou_matrix(boxes_a, boxes_b)
+    for flat in np.argsort(-ious, axis=None):
+        i, j = np.unravel_index(flat, ious.shape)
+        if ious[i, j] < min_iou:
+            break
+        if i not in pairs and j not in pairs.values():
+            pairs[int(i)] = int(j)
+    if len(pairs) < min(len(boxes_a), len(boxes_b)):
+        a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+        sizes = np.maximum(a[:, 1] - a[:, 3], a[:, 2] - a[:, 0])
+        dists = np.linalg.norm(_centers(boxes_a)[:, None] - _centers(boxes_b)[None], axis=2)
+        dists /= np.maximum(sizes[:, None], 1)
+        for flat in np.argsort(dists, axis=None):
+            i, j = np.unravel_index(flat, dists.shape)
+            if dists[i, j] > max_shift:
+                break
+            if i not in pairs and j not in pairs.values():
+                pairs[int(i)] = int(j)
+    return pairs
+
+
+def landmarks_box(landmarks, width, height):
+    # Pixel bounding box of a MediaPipe landmark list
+    xs = [p.x for p in landmarks.landmark]
+    ys = [p.y for p in landmarks.landmark]
+    return (int(min(ys) * height), int(max(xs) * width), int(max(ys) * height), int(min(xs) * width))
+
+
+class Track:
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = tuple(int(v) for v in box)
+        self.name = None
+        self.distance = None
+        self.encoding = None   # the encoding behind the best match
+        self.encoded = False
+        self.misses = 0
+        self.detections_since_encode = 0
+
+    @property
+    def needs_encoding(self):
+        return not self.encoded or self.name is None or self.distance > CONFIDENT_DISTANCE
+
+    def set_match(self, match, encoding=None):
+        # Keep the closer of the previous and the new match
+        self.encoded = True
+        self.detections_since_encode = 0
+        if match['distance'] is None:
+            return  # empty gallery
+        if self.distance is None or match['distance'] < self.distance:
+            self.name = match['name']
+            self.distance = match['distance']
+            self.encoding = encoding
+
+
+class FaceTracker:
+    def __init__(self, redetect_every=REDETECT_EVERY, min_iou=MIN_IOU, max_misses=MAX_MISSES,
+                 optical_flow=True, reverify_every=None):
+        self.redetect_every = redetect_every
+        self.reverify_every = reverify_every
+        self.min_iou = min_iou
+        self.max_misses = max_misses
+        self.optical_flow = optical_flow
+        self.tracks = []
+        self.frame_index = 0
+        self._ids = itertools.count(1)
+        self._prev_gray = None
+
+    def due_for_detection(self):
+        # True on the first frame, every redetect_every frames, and whenever
+        # there is nothing to track
+        return not self.tracks or self.frame_index % self.redetect_every == 0
+
+    def next_frame(self, gray=None):
+        # Advance to a new frame. Without a detection, tracks are moved by
+        # optical flow from the previous frame when gray frames are given.
+        if gray is not None and self.optical_flow and self._prev_gray is not None and self.tracks:
+            self._propagate(self._prev_gray, gray)
+        self._prev_gray = gray
+        self.frame_index += 1
+
+    def update(self, boxes):
+        # Feed the detector's boxes for the current frame. Returns the tracks
+        # that need (re-)encoding: new ones, those with uncertain identity and,
+        # with reverify_every, those due for an identity check.
+        pairs = associate([t.box for t in self.tracks], boxes, self.min_iou)
+        matched = set(pairs.values())
+        kept = []
+        for i, track in enumerate(self.tracks):
+            if i in pairs:
+                track.box = tuple(int(v) for v in boxes[pairs[i]])
+                track.misses = 0
+                track.detections_since_encode += 1
+            else:
+                track.misses += 1
+            if track.misses <= self.max_misses:
+                kept.append(track)
+        for j, box in enumerate(boxes):
+            if j not in matched:
+                kept.append(Track(next(self._ids), box))
+        self.tracks = kept
+        return [t for t in self.tracks if t.misses == 0 and (t.needs_encoding or self._due_for_reverify(t))]
+
+    def _due_for_reverify(self, track):
+        return self.reverify_every is not None and track.detections_since_encode >= self.reverify_every
+
+    def reset(self, track):
+        # Replace track with a new one (new id, no identity) at the same box
+        fresh = Track(next(self._ids), track.box)
+        self.tracks[self.tracks.index(track)] = fresh
+        return fresh
+
+    def assign(self, boxes):
+        # Map other per-face outputs (e.g. landmark boxes) onto the current
+        # tracks. Returns {track: index in boxes}.
+        pairs = associate([t.box for t in self.tracks], boxes, self.min_iou)
+        return {self.tracks[i]: j for i, j in pairs.items()}
+
+    def _propagate(self, prev_gray, gray):
+        h, w = gray.shape[:2]
+        for track in self.tracks:
+            top, right, bottom, left = track.box
+            mask = np.zeros_like(prev_gray)
+            mask[max(top, 0):max(bottom, 0), max(left, 0):max(right, 0)] = 255
+            points = cv2.goodFeaturesToTrack(prev_gray, maxCorners=30, qualityLevel=0.01,
+                                             minDistance=5, mask=mask)
+            if points is None:
+                continue
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points, None)
+            good = status.reshape(-1) == 1
+            if not good.any():
+                continue
+            dx, dy = np.median((moved - points).reshape(-1, 2)[good], axis=0)
+            dx = int(round(float(np.clip(dx, -left, w - right))))
+            dy = int(round(float(np.clip(dy, -top, h - bottom))))
+            track.box = (top + dy, right + dx, bottom + dy, left + dx)
@@ -4,12 +4,19 @@ import numpy as np
 import face_recognition
 from datetime import datetime
 import mediapipe as mp
-import smtplib
-from email.message import EmailMessage
 import logging
 import dlib
 import csv
-import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from face_index import ENCODING_DIM, create_index, face_distance_matrix, load_index
+from notifications import NotificationQueue
+from db import Database
+from migrations import apply_migrations
+from encoding_batcher import encoding_batcher, ENCODING_VERSION
+from embedding_cache import embedding_cache
+from face_tracker import FaceTracker, REVERIFY_EVERY, iou_matrix
 
 # Configure logging
 logging.basicConfig(
@@ -24,326 +31,1235 @@ ATTENDANCE_FILE = 'attendance.csv'
 if not os.path.exists(REGISTERED_DIR):
     os.makedirs(REGISTERED_DIR)
 
-# Initialize the database
+# Initialize the database. All queries go through the pooled connections
+# in db.py.
 DB_FILE = 'database.db'
+database = Database(DB_FILE)
 
+# Create or upgrade the schema (see migrations.py)
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    # Create users table with face_image column
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            name TEXT PRIMARY KEY,
-            email TEXT NOT NULL,
-            rollno TEXT NOT NULL,
-            face_image BLOB
-        )
-    ''')
-    # Create attendance table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS attendance (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            date TEXT NOT NULL,
-            time TEXT NOT NULL,
-            status TEXT NOT NULL,
-            FOREIGN KEY (name) REFERENCES users (name)
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-# Save user data with face image to the database
-def save_user_data(name, email, rollno, face_image):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO users (name, email, rollno, face_image)
-        VALUES (?, ?, ?, ?)
-    ''', (name, email, rollno, face_image))
-    conn.commit()
-    conn.close()
+    apply_migrations(database)
+
+# Attendance days are stored as YYYYMMDD integers alongside the text date
+def date_to_day(date):
+    return int(datetime.strptime(date, '%Y-%m-%d').strftime('%Y%m%d'))
+
+# Compute the 128-d encoding of the first face in a JPEG/PNG byte string.
+# Results are cached by image hash (see embedding_cache.py), so re-registering
+# or re-importing the same photo skips detection and encoding.
+def compute_face_encoding(face_image):
+    return embedding_cache.embedding(face_image)['encoding']
+
+def encoding_to_blob(enc):
+    return np.asarray(enc, dtype=np.float32).tobytes()
+
+def encoding_from_blob(blob):
+    if not blob or len(blob) != ENCODING_DIM * 4:
+        return None
+    return np.frombuffer(blob, dtype=np.float32)
+
+# Today's attendance_daily_summary rows hold the enrolment at the day's first
+# mark; re-count them when students are added, moved or removed so present
+# never exceeds enrolled.
+def _refresh_enrolled(conn):
+    conn.execute('''
+        UPDATE attendance_daily_summary
+        SET enrolled = (SELECT COUNT(*) FROM users WHERE users.class_name = attendance_daily_summary.class_name)
+        WHERE day = ?
+    ''', (int(datetime.now().strftime('%Y%m%d')),))
+
+def _add_to_summary(conn, day, class_name, present_delta, absent_delta):
+    conn.execute('''
+        INSERT INTO attendance_daily_summary (day, class_name, enrolled, present_count, absent_count)
+        VALUES (?, ?, (SELECT COUNT(*) FROM users WHERE class_name = ?), ?, ?)
+        ON CONFLICT (day, class_name) DO UPDATE SET
+            present_count = present_count + excluded.present_count,
+            absent_count = absent_count + excluded.absent_count
+    ''', (day, class_name, class_name, present_delta, absent_delta))
+
+# When a student changes class, today's attendance row and its count in the
+# daily summary move to the new class with them. Earlier days keep the class
+# the student had then.
+def _move_todays_attendance(conn, name):
+    day = int(datetime.now().strftime('%Y%m%d'))
+    row = conn.execute('''
+        SELECT a.status, a.class_name, u.class_name FROM attendance a JOIN users u ON u.name = a.name
+        WHERE a.name = ? AND a.day = ?
+    ''', (name, day)).fetchone()
+    if row is None or row[1] == row[2]:
+        return
+    status, old_class, new_class = row
+    present, absent = int(status == 'present'), int(status == 'absent')
+    conn.execute('UPDATE attendance SET class_name = ? WHERE name = ? AND day = ?', (new_class, name, day))
+    _add_to_summary(conn, day, old_class, -present, -absent)
+    _add_to_summary(conn, day, new_class, present, absent)
+
+# Save user data with face image to the database. The face encoding is
+# computed once here and stored alongside the image.
+# class_name=None keeps the user's current class.
+def save_user_data(name, email, rollno, face_image, class_name=None):
+    enc = compute_face_encoding(face_image) if face_image else None
+    save_users([(name, email, rollno, face_image, enc, class_name)])
+    return enc is not None
+
+# Save many users with precomputed encodings in one transaction, e.g. from
+# the bulk enroller. users yields (name, email, rollno, face_image, encoding,
+# class_name) tuples; encoding may be None. Each encoding is added to the
+# user's embedding set, so registering someone again adds a photo rather
+# than replacing the old one. Returns the number saved.
+def save_users(users):
+    saved = 0
+    enrolled = []
+    with database.transaction() as conn:
+        for name, email, rollno, face_image, enc, class_name in users:
+            conn.execute('''
+                INSERT OR REPLACE INTO users (name, email, rollno, face_image, face_encoding, encoding_version, class_name)
+                VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, (SELECT class_name FROM users WHERE name = ?), ''))
+            ''', (name, email, rollno, face_image,
+                  encoding_to_blob(enc) if enc is not None else None,
+                  ENCODING_VERSION if enc is not None else None,
+                  class_name, name))
+            _move_todays_attendance(conn, name)
+            saved += 1
+            if enc is not None:
+                enrolled.append((name, add_user_embedding(conn, name, enc, 'register', face_image)))
+        _refresh_enrolled(conn)
+    invalidate_roster()
+    for name, encs in enrolled:
+        gallery_set(name, encs)
+    return saved
+
+# Update a user's contact details (and optionally class). Returns False if
+# there is no such user.
+def update_user(name, email, rollno, class_name=None):
+    with database.transaction() as conn:
+        changed = conn.execute('''
+            UPDATE users SET email = ?, rollno = ?, class_name = COALESCE(?, class_name) WHERE name = ?
+        ''', (email, rollno, class_name, name)).rowcount
+        _move_todays_attendance(conn, name)
+        _refresh_enrolled(conn)
+    invalidate_roster()
+    return changed > 0
 
 # Fetch face image by name
 def fetch_face_image(name):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT face_image FROM users WHERE name = ?', (name,))
-    result = cursor.fetchone()
-    conn.close()
+    result = database.query_one('SELECT face_image FROM users WHERE name = ?', (name,))
     return result[0] if result else None
 
-# Save attendance record to the database
+# Save attendance record to the database. There is one row per user per
+# day; saving again only changes the row if the status differs. Returns True
+# if a row was inserted or changed.
+# The per-day/per-class totals in attendance_daily_summary are updated in
+# the same transaction.
 def save_attendance(name, date, time, status):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO attendance (name, date, time, status)
-        VALUES (?, ?, ?, ?)
-    ''', (name, date, time, status))
-    conn.commit()
-    conn.close()
-
-# Fetch all users from the database
+    day = date_to_day(date)
+    first_seen = time if status == 'present' else None
+    with database.transaction(immediate=True) as conn:
+        row = conn.execute('SELECT status, class_name FROM attendance WHERE name = ? AND day = ?',
+                           (name, day)).fetchone()
+        if row is not None and row[0] == status:
+            return False
+        if row is not None:
+            old_status, class_name = row
+            conn.execute('''
+                UPDATE attendance SET time = ?, status = ?, first_seen = COALESCE(first_seen, ?)
+                WHERE name = ? AND day = ?
+            ''', (time, status, first_seen, name, day))
+        else:
+            old_status = None
+            user = conn.execute('SELECT class_name FROM users WHERE name = ?', (name,)).fetchone()
+            class_name = user[0] if user else ''
+            conn.execute('''
+                INSERT INTO attendance (name, date, day, time, status, first_seen, class_name)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (name, date, day, time, status, first_seen, class_name))
+        present_delta = (status == 'present') - (old_status == 'present')
+        absent_delta = (status == 'absent') - (old_status == 'absent')
+        _add_to_summary(conn, day, class_name, present_delta, absent_delta)
+    return True
+
+# The users table is the only roster. It is cached in memory as
+# {name: (email, rollno, class_name)} and reloaded after any register, edit
+# or delete, so status and recognition lookups don't query it each time.
+_roster_lock = threading.Lock()
+_roster = None
+
+def get_roster():
+    global _roster
+    with _roster_lock:
+        if _roster is None:
+            _roster = {name: (email, rollno, class_name) for name, email, rollno, class_name in
+                       database.query_all('SELECT name, email, rollno, class_name FROM users ORDER BY name')}
+        return _roster
+
+def invalidate_roster():
+    global _roster
+    with _roster_lock:
+        _roster = None
+
+# Fetch all users as (name, email, rollno)
 def fetch_all_users():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT name, email, rollno FROM users')
-    users = cursor.fetchall()
-    conn.close()
-    return users
+    return [(name, email, rollno) for name, (email, rollno, _) in get_roster().items()]
 
 # Fetch a single user by name
 def fetch_user_by_name(name):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT name, email, rollno FROM users WHERE name = ?', (name,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+    user = get_roster().get(name)
+    return (name, user[0], user[1]) if user else None
 
 # Fetch attendance records for a specific date
 def fetch_attendance_by_date(date):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT name, date, time, status FROM attendance WHERE date = ?
-    ''', (date,))
-    records = cursor.fetchall()
-    conn.close()
-    return records
-
-# Fetch all attendance records
-def fetch_all_attendance():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT name, date, time, status FROM attendance
-    ''')
-    records = cursor.fetchall()
-    conn.close()
-    return records
+    return database.query_all('''
+        SELECT name, date, time, status FROM attendance WHERE day = ?
+    ''', (date_to_day(date),))
+
+# Fetch one page of attendance records (oldest first), optionally filtered
+# by an inclusive date range and name. Pass the last id of the previous page
+# as after_id to get the next page.
+def fetch_attendance_page(start_date=None, end_date=None, name=None, after_id=None, limit=100):
+    clauses, params = [], []
+    if start_date:
+        clauses.append('day >= ?')
+        params.append(date_to_day(start_date))
+    if end_date:
+        clauses.append('day <= ?')
+        params.append(date_to_day(end_date))
+    if name:
+        clauses.append('name = ?')
+        params.append(name)
+    if after_id is not None:
+        clauses.append('id > ?')
+        params.append(after_id)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    return database.query_all(f'''
+        SELECT id, name, date, time, status FROM attendance {where}
+        ORDER BY id LIMIT ?
+    ''', (*params, limit))
+
+# Stream attendance records (name, day, time, status) from a server-side
+# cursor, for all dates or a single date
+def iter_attendance(date=None, batch_size=1000):
+    if date:
+        return database.iter_query('''
+            SELECT name, day, time, status FROM attendance WHERE day = ? ORDER BY name
+        ''', (date_to_day(date),), batch_size)
+    return database.iter_query('SELECT name, day, time, status FROM attendance ORDER BY id', (), batch_size)
 
 # Delete a user by name
 def delete_user(name):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM users WHERE name = ?', (name,))
-    conn.commit()
-    conn.close()
+    with database.transaction() as conn:
+        conn.execute('DELETE FROM users WHERE name = ?', (name,))
+        conn.execute('DELETE FROM user_embeddings WHERE name = ?', (name,))
+        _refresh_enrolled(conn)
+    invalidate_roster()
+    gallery_remove(name)
 
 # Initialize the database when the app starts
 init_db()
 
-def update_database_schema():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    try:
-        # Add the face_image column if it doesn't exist
-        cursor.execute('''
-            ALTER TABLE users ADD COLUMN face_image BLOB
-        ''')
-        conn.commit()
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e).lower():
-            print("Column 'face_image' already exists.")
-        else:
-            raise
-    finally:
-        conn.close()
-
-# Call the function to update the schema
-update_database_schema()
+# Attendance emails are queued and delivered by the background worker in
+# notifications.py (started by the app), so marking attendance never waits
+# on SMTP.
+notification_queue = NotificationQueue(database)
 
 def send_email_notification(email, name):
-    sender_email = "abhaychauhan5051@gmail.com"  # Replace with your email
-    sender_password = "csvklapxmsnhubxj"  # Replace with your email password
-    smtp_server = "smtp.gmail.com"
-    smtp_port = 587
+    notification_queue.enqueue(
+        email,
+        "Attendance Marked",
+        f"Hello {name},\n\nYour attendance has been successfully marked.\n\nThank you!\n",
+    )
 
-    msg = EmailMessage()
-    msg.set_content(f"Hello {name},\n\nYour attendance has been successfully marked.\n\nThank you!\n")
-    msg["Subject"] = "Attendance Marked"
-    msg["From"] = sender_email
-    msg["To"] = email
+# Names already marked present today. Loaded from the database on first use
+# and whenever the date rolls over, so repeat recognitions of the same person
+# are answered from memory without touching the database or sending email.
+_present_lock = threading.Lock()
+_present_date = None
+_present_names = set()
 
-    try:
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-            logging.info(f"Email successfully sent to {email}")
-    except Exception as e:
-        logging.error(f"Failed to send email to {email}: {e}")
-        print(f"Failed to send email to {email}: {e}")
+def _present_set(date):
+    # Caller must hold _present_lock
+    global _present_date, _present_names
+    if _present_date != date:
+        records = fetch_attendance_by_date(date)
+        _present_names = {name for name, _, _, status in records if status == 'present'}
+        _present_date = date
+    return _present_names
+
+def is_already_present_today(name, date=None):
+    today = datetime.now().strftime('%Y-%m-%d')
+    date = date or today
+    if date == today:
+        with _present_lock:
+            return name in _present_set(today)
+    return any(n == name and status == 'present' for n, _, _, status in fetch_attendance_by_date(date))
 
 def mark_attendance(name):
-    date = datetime.now().strftime('%Y-%m-%d')
-    time = datetime.now().strftime('%H:%M:%S')
-    attendance_file = 'attendance.csv'
+    # Returns True if the user was newly marked present today
+    now = datetime.now()
+    date = now.strftime('%Y-%m-%d')
+    time = now.strftime('%H:%M:%S')
+    with _present_lock:
+        present = _present_set(date)
+        if name in present:
+            return False
+        # Reserve the name so concurrent requests don't mark it twice
+        present.add(name)
     user = fetch_user_by_name(name)
-    if user:
-        _, email, rollno = user
-        save_attendance(name, date, time, 'present')
-        send_email_notification(email, name)
-
-def is_already_present_today(name, date):
-    if not os.path.exists(ATTENDANCE_FILE):
+    if not user:
+        with _present_lock:
+            _present_set(date).discard(name)
         return False
-    with open(ATTENDANCE_FILE, 'r') as f:
-        for line in f:
-            parts = line.strip().split(',')
-            if len(parts) >= 4 and parts[0] == name and parts[1] == date and parts[3] == 'present':
-                return True
+    _, email, rollno = user
+    if save_attendance(name, date, time, 'present'):
+        if email:
+            send_email_notification(email, name)
+        return True
     return False
 
 def mark_attendance_status(name, date, status):
     # status: 'present' or 'absent'
     now = datetime.now().strftime('%H:%M:%S')
     save_attendance(name, date, now, status)
+    with _present_lock:
+        if date == _present_date:
+            if status == 'present':
+                _present_names.add(name)
+            else:
+                _present_names.discard(name)
 
 def get_attendance_status(date):
     # Returns dict: {name: 'present'/'absent'} for all registered users for the date
-    status = {}
-    users = [os.path.splitext(fn)[0] for fn in os.listdir(REGISTERED_DIR) if fn.lower().endswith('.jpg')]
-    for user in users:
-        status[user] = 'absent'
+    status = dict.fromkeys(get_roster(), 'absent')
     records = fetch_attendance_by_date(date)
     for record in records:
         name, _, _, status_value = record
         status[name] = status_value
     return status
 
+# Daily analytics served from attendance_daily_summary: the cost depends on
+# the number of days and classes, not on the number of attendance rows.
+def _enrolled_by_class():
+    return dict(database.query_all('SELECT class_name, COUNT(*) FROM users GROUP BY class_name'))
+
+def fetch_daily_summaries(start_date, end_date, class_name=None):
+    # Returns [(date, enrolled, present, absent)] for every day in the range
+    # that has attendance marks. Enrolment is the snapshot taken when the
+    # day's first mark was recorded (kept current for today), never less than
+    # the number present; classes with no marks that day count with their
+    # current size.
+    params = [date_to_day(start_date), date_to_day(end_date)]
+    class_filter = ''
+    if class_name is not None:
+        class_filter = 'AND class_name = ?'
+        params.append(class_name)
+    rows = database.query_all(f'''
+        SELECT day, class_name, enrolled, present_count FROM attendance_daily_summary
+        WHERE day BETWEEN ? AND ? {class_filter} ORDER BY day
+    ''', params)
+    current = _enrolled_by_class()
+    if class_name is not None:
+        current = {class_name: current.get(class_name, 0)}
+    days = {}
+    for day, cls, enrolled, present in rows:
+        days.setdefault(day, {})[cls] = (max(enrolled, present), present)
+    summaries = []
+    for day, classes in days.items():
+        enrolled = sum(e for e, _ in classes.values())
+        enrolled += sum(n for cls, n in current.items() if cls not in classes)
+        present = sum(p for _, p in classes.values())
+        summaries.append((f'{day // 10000:04d}-{day // 100 % 100:02d}-{day % 100:02d}',
+                          enrolled, present, max(enrolled - present, 0)))
+    return summaries
+
+def get_daily_summary(date, class_name=None):
+    # (enrolled, present, absent) for one date
+    summaries = fetch_daily_summaries(date, date, class_name)
+    if summaries:
+        return summaries[0][1:]
+    current = _enrolled_by_class()
+    enrolled = current.get(class_name, 0) if class_name is not None else sum(current.values())
+    return enrolled, 0, enrolled
+
+def get_attendance_streaks(name):
+    # Current and longest run of consecutive school days (days on which the
+    # student's class had any marks) that the student was present
+    user = database.query_one('SELECT class_name FROM users WHERE name = ?', (name,))
+    if user is None:
+        return None
+    school_days = [row[0] for row in database.query_all(
+        'SELECT day FROM attendance_daily_summary WHERE class_name = ? ORDER BY day', (user[0],))]
+    present_days = {row[0] for row in database.query_all(
+        "SELECT day FROM attendance WHERE name = ? AND status = 'present'", (name,))}
+    current = longest = 0
+    for day in school_days:
+        current = current + 1 if day in present_days else 0
+        longest = max(longest, current)
+    return {'name': name, 'current_streak': current, 'longest_streak': longest,
+            'days_present': len(present_days), 'school_days': len(school_days)}
+
+# In-memory gallery: a face_index index (exact for small galleries, IVF
+# partitioned once the gallery reaches ANN_MIN_GALLERY) holding one float32
+# row per user, the centroid of the user's embedding set, plus the sets
+# themselves in _embedding_sets. Loaded once at startup, persisted to
+# INDEX_FILE so large indexes are not retrained on restart, and kept in sync
+# by save_users / auto_enrol / delete_user. _gallery_version counts those
+# changes so copies of the gallery in other processes (recognition_service
+# workers) know to reload.
+INDEX_FILE = 'face_index.npz'
+ANN_MIN_GALLERY = 10000
+ANN_NPROBE = 8
+INDEX_SAVE_DELAY = 5.0
+
+# Embedding sets. Each user keeps up to MAX_EMBEDDINGS_PER_USER embeddings
+# in user_embeddings: one per registration photo and, with AUTO_ENROL=1,
+# frames from live matches closer than AUTO_ENROL_DISTANCE (at most one per
+# user per AUTO_ENROL_INTERVAL_SECONDS, and only if they differ from what is
+# already enrolled). Once a set has three or more embeddings, those farther
+# than EMBEDDING_OUTLIER_DISTANCE from its centroid are pruned; past the cap
+# the most redundant one (closest to another) goes.
+MAX_EMBEDDINGS_PER_USER = int(os.environ.get('MAX_EMBEDDINGS_PER_USER', 5))
+EMBEDDING_OUTLIER_DISTANCE = 0.5
+EMBEDDING_DUPLICATE_DISTANCE = 0.05
+AUTO_ENROL = os.environ.get('AUTO_ENROL', '0') == '1'
+AUTO_ENROL_DISTANCE = 0.4
+AUTO_ENROL_MIN_NOVELTY = 0.2
+AUTO_ENROL_INTERVAL_SECONDS = 3600
+
+_gallery_lock = threading.Lock()
+_gallery_index = None
+_embedding_sets = {}
+_index_save_timer = None
+_gallery_version = 0
+
+# persist=False skips backfilling and writing INDEX_FILE, for processes that
+# only read the gallery
+def load_gallery(persist=True):
+    global _gallery_index, _embedding_sets
+    grouped = {}
+    for name, blob in database.iter_query('''
+        SELECT name, encoding FROM user_embeddings WHERE encoding_version = ? ORDER BY name, id
+    ''', (ENCODING_VERSION,)):
+        enc = encoding_from_blob(blob)
+        if enc is not None:
+            grouped.setdefault(name, []).append(enc)
+
+    # Re-encode registration photos encoded by an older encoder version (or
+    # never encoded); stale auto-enrolled frames have no photo and are dropped
+    stale = database.query_all('''
+        SELECT id, name, face_image FROM user_embeddings
+        WHERE encoding_version != ? OR encoding IS NULL
+    ''', (ENCODING_VERSION,)) if persist else []
+    for row_id, name, face_image in stale:
+        enc = compute_face_encoding(face_image) if face_image else None
+        if enc is None:
+            database.execute('DELETE FROM user_embeddings WHERE id = ?', (row_id,))
+            continue
+        database.execute('UPDATE user_embeddings SET encoding = ?, encoding_version = ? WHERE id = ?',
+                         (encoding_to_blob(enc), ENCODING_VERSION, row_id))
+        grouped.setdefault(name, []).append(enc)
+
+    sets = {name: np.vstack(encs) for name, encs in grouped.items()}
+    names = list(sets)
+    matrix = (np.vstack([sets[name].mean(axis=0) for name in names]) if names
+              else np.empty((0, ENCODING_DIM), dtype=np.float32))
+    index = load_index(INDEX_FILE, ENCODING_VERSION)
+    expected_kind = create_index(len(names), ANN_MIN_GALLERY).kind
+    if index is None or index.kind != expected_kind or index.needs_rebuild():
+        index = create_index(len(names), ANN_MIN_GALLERY, ANN_NPROBE).build(names, matrix)
+        if persist:
+            index.save(INDEX_FILE, ENCODING_VERSION)
+    else:
+        # Reconcile the persisted index with user_embeddings incrementally
+        wanted = dict(zip(names, matrix))
+        for name in list(index.names):
+            if name not in wanted:
+                index.remove(name)
+        for name, enc in wanted.items():
+            current = index.get(name)
+            if current is None or not np.array_equal(current, enc):
+                index.add(name, enc)
+    with _gallery_lock:
+        _gallery_index = index
+        _embedding_sets = sets
+    logging.info(f"Loaded {index.kind} face index with {len(index)} users, "
+                 f"{sum(len(encs) for encs in sets.values())} embeddings ({len(stale)} re-encoded)")
+
+def prune_embedding_set(encs, cap=MAX_EMBEDDINGS_PER_USER, outlier_distance=EMBEDDING_OUTLIER_DISTANCE):
+    # Sorted indices of the embeddings to keep
+    keep = np.arange(len(encs))
+    if len(encs) >= 3:
+        dists = face_distance_matrix(encs, encs.mean(axis=0))[:, 0]
+        inliers = keep[dists <= outlier_distance]
+        if len(inliers):
+            keep = inliers
+    while len(keep) > cap:
+        pairwise = face_distance_matrix(encs[keep], encs[keep])
+        np.fill_diagonal(pairwise, np.inf)
+        keep = np.delete(keep, np.argmin(pairwise.min(axis=1)))
+    return keep
+
+def add_user_embedding(conn, name, enc, source, face_image=None, distance=None):
+    # Add enc to name's embedding set inside the caller's transaction and
+    # prune the set. Near-duplicates of an existing embedding are not added.
+    # Returns the user's embeddings afterwards as a matrix.
+    rows = conn.execute('''
+        SELECT id, encoding FROM user_embeddings WHERE name = ? AND encoding_version = ? ORDER BY id
+    ''', (name, ENCODING_VERSION)).fetchall()
+    ids = [row_id for row_id, _ in rows]
+    encs = [encoding_from_blob(blob) for _, blob in rows]
+    enc = np.asarray(enc, dtype=np.float32)
+    if encs and face_distance_matrix(enc, encs).min() < EMBEDDING_DUPLICATE_DISTANCE:
+        return np.vstack(encs)
+    ids.append(conn.execute('''
+        INSERT INTO user_embeddings (name, encoding, encoding_version, source, face_image, distance, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (name, encoding_to_blob(enc), ENCODING_VERSION, source, face_image, distance,
+          datetime.now().strftime('%Y-%m-%d %H:%M:%S'))).lastrowid)
+    matrix = np.vstack(encs + [enc])
+    keep = prune_embedding_set(matrix)
+    dropped = set(range(len(ids))) - set(keep.tolist())
+    if dropped:
+        conn.executemany('DELETE FROM user_embeddings WHERE id = ?', [(ids[i],) for i in dropped])
+    return matrix[keep]
+
+_auto_enrol_lock = threading.Lock()
+_last_auto_enrol = {}
+
+# Add a frame from a confident, live match to the user's embedding set.
+# Returns True if it was added.
+def auto_enrol(name, enc, distance):
+    if not AUTO_ENROL or distance is None or distance > AUTO_ENROL_DISTANCE:
+        return False
+    current = _embedding_sets.get(name)
+    if current is None or face_distance_matrix(enc, current).min() < AUTO_ENROL_MIN_NOVELTY:
+        return False
+    now = time.monotonic()
+    with _auto_enrol_lock:
+        if now - _last_auto_enrol.get(name, -AUTO_ENROL_INTERVAL_SECONDS) < AUTO_ENROL_INTERVAL_SECONDS:
+            return False
+        _last_auto_enrol[name] = now
+    with database.transaction(immediate=True) as conn:
+        if conn.execute('SELECT 1 FROM users WHERE name = ?', (name,)).fetchone() is None:
+            return False
+        encs = add_user_embedding(conn, name, enc, 'auto', distance=distance)
+    gallery_set(name, encs)
+    logging.info(f"Auto-enrolled a new embedding for {name} (distance {distance:.3f})")
+    return True
+
+def _schedule_index_save():
+    # Coalesce bursts of register/delete calls into one write of INDEX_FILE
+    global _index_save_timer
+    if _index_save_timer is not None:
+        _index_save_timer.cancel()
+    _index_save_timer = threading.Timer(INDEX_SAVE_DELAY, _gallery_index.save,
+                                        args=(INDEX_FILE, ENCODING_VERSION))
+    _index_save_timer.daemon = True
+    _index_save_timer.start()
+
+def gallery_set(name, encs):
+    # Replace name's embedding set; the index gets its centroid
+    global _gallery_version
+    with _gallery_lock:
+        _gallery_version += 1
+        _embedding_sets[name] = encs
+        if _gallery_index is None:
+            return
+        _gallery_index.add(name, encs.mean(axis=0))
+        _schedule_index_save()
+
+def gallery_remove(name):
+    global _gallery_version
+    with _gallery_lock:
+        _gallery_version += 1
+        _embedding_sets.pop(name, None)
+        if _gallery_index is None:
+            return
+        if _gallery_index.remove(name):
+            _schedule_index_save()
+
+def get_gallery_stats():
+    # Gallery size and memory: the index holds one centroid per user, the
+    # embedding sets up to MAX_EMBEDDINGS_PER_USER rows each
+    with _gallery_lock:
+        index, sets = _gallery_index, dict(_embedding_sets)
+    return {'users': len(sets), 'embeddings': sum(len(encs) for encs in sets.values()),
+            'max_embeddings_per_user': MAX_EMBEDDINGS_PER_USER, 'auto_enrol': AUTO_ENROL,
+            'index_bytes': index.nbytes if index is not None else 0,
+            'embedding_bytes': sum(encs.nbytes for encs in sets.values())}
+
+def get_gallery_version():
+    return _gallery_version
+
+def get_gallery_index():
+    if _gallery_index is None:
+        load_gallery()
+    return _gallery_index
+
 def load_registered_faces():
-    encs, names = [], []
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT name, face_image FROM users')
-    users = cursor.fetchall()
-    conn.close()
-
-    for name, face_image in users:
-        if face_image:
-            # Decode the face image from binary and compute face encodings
-            nparr = np.frombuffer(face_image, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            enc = face_recognition.face_encodings(img)
-            if enc:
-                encs.append(enc[0])
-                names.append(name)
-    return encs, names
+    # Returns a copy of the gallery as (per-user centroid matrix, names)
+    index = get_gallery_index()
+    with index.lock:
+        return index.encodings.copy(), list(index.names)
+
+# Matching: a probe matches a user when the euclidean distance to the
+# user's nearest embedding is within MATCH_TOLERANCE (face_recognition's
+# default of 0.6). The index is searched by centroid and the MATCH_RERANK
+# nearest users are then re-scored against their full embedding sets.
+MATCH_TOLERANCE = 0.6
+MATCH_TOP_K = 3
+MATCH_RERANK = 5
+
+def match_faces(probe_encs, tolerance=MATCH_TOLERANCE, top_k=MATCH_TOP_K):
+    """
+    Match all probe encodings from a frame against the gallery at once.
+    Returns one dict per probe: { 'name': str or None, 'distance': float or None,
+    'candidates': [(name, distance), ...] } with up to top_k nearest candidates.
+    """
+    if len(probe_encs) == 0:
+        return []
+    index = get_gallery_index()
+    probes = np.asarray(probe_encs, dtype=np.float32).reshape(-1, ENCODING_DIM)
+    with index.lock:
+        rows, _ = index.search(probes, max(1, top_k, MATCH_RERANK))
+        names = index.names
+        sets = _embedding_sets
+        matches = []
+        for probe, row_ids in zip(probes, rows):
+            row_ids = row_ids[row_ids >= 0]
+            candidate_sets = [sets.get(names[r], index.encodings[r:r + 1]) for r in row_ids]
+            candidates = []
+            if candidate_sets:
+                offsets = np.cumsum([0] + [len(encs) for encs in candidate_sets[:-1]])
+                nearest = np.minimum.reduceat(face_distance_matrix(probe, np.vstack(candidate_sets))[0], offsets)
+                candidates = [(names[row_ids[i]], float(nearest[i]))
+                              for i in np.argsort(nearest, kind='stable')[:top_k]]
+            if not candidates:
+                matches.append({'name': None, 'distance': None, 'candidates': []})
+                continue
+            best_name, best_dist = candidates[0]
+            matches.append({
+                'name': best_name if best_dist <= tolerance else None,
+                'distance': best_dist,
+                'candidates': candidates,
+            })
+    return matches
 
 def save_face_image(name, img_bgr):
     path = os.path.join(REGISTERED_DIR, f'{name}.jpg')
     cv2.imwrite(path, img_bgr)
     return path
 
-def recognize_faces_and_liveness(img_bgr):
+# Model registry. Detectors and meshes are expensive to construct, so each
+# model is created lazily and reused for the life of the process. dlib's CNN
+# and MediaPipe's FaceMesh graphs must not be used from two threads at once,
+# so they are kept in pools: a request checks out an idle instance (creating
+# one only when all are busy) and returns it when done.
+CNN_DETECTOR_FILE = 'mmod_human_face_detector.dat'
+
+_stats_lock = threading.Lock()
+_model_stats = {}
+
+def _record_model_stat(name, key, seconds):
+    with _stats_lock:
+        stat = _model_stats.setdefault(name, {'loads': 0, 'load_s': 0.0, 'calls': 0, 'inference_s': 0.0})
+        if key == 'load':
+            stat['loads'] += 1
+            stat['load_s'] += seconds
+        else:
+            stat['calls'] += 1
+            stat['inference_s'] += seconds
+
+@contextmanager
+def timed_inference(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_model_stat(name, 'inference', time.perf_counter() - start)
+
+@contextmanager
+def timed_stage(timings, name):
+    # Per-request counterpart of timed_inference: adds the elapsed
+    # milliseconds to timings[name]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+def get_model_stats():
+    # Per-model load vs. inference time, in milliseconds
+    with _stats_lock:
+        stats = {}
+        for name, s in _model_stats.items():
+            stats[name] = {
+                'instances': s['loads'],
+                'load_ms_total': round(s['load_s'] * 1000, 2),
+                'calls': s['calls'],
+                'inference_ms_avg': round(s['inference_s'] * 1000 / s['calls'], 2) if s['calls'] else None,
+                'inference_ms_total': round(s['inference_s'] * 1000, 2),
+            }
+        return stats
+
+class ModelPool:
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self):
+        with self._lock:
+            model = self._idle.pop() if self._idle else None
+        if model is None:
+            start = time.perf_counter()
+            model = self.factory()
+            _record_model_stat(self.name, 'load', time.perf_counter() - start)
+        try:
+            yield model
+        finally:
+            with self._lock:
+                self._idle.append(model)
+
+def _create_face_mesh():
+    # Runs on one face crop at a time (see roi_landmarks)
+    return mp.solutions.face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1, refine_landmarks=True)
+
+cnn_detector_pool = ModelPool('cnn_detector', lambda: dlib.cnn_face_detection_model_v1(CNN_DETECTOR_FILE))
+face_mesh_pool = ModelPool('face_mesh', _create_face_mesh)
+
+# Detection cascade. A fast detector (dlib HOG or MediaPipe, FAST_DETECTOR)
+# runs on a copy of the frame downscaled for detection (see
+# FramePreprocessor) and its boxes are mapped back to full resolution. The CNN
+# detector only runs when the fast stage is unsure: on a padded crop around
+# each detection scoring below CASCADE_MIN_SCORE, or on the whole frame when
+# the fast stage finds fewer faces than expected (e.g. than the tracker is
+# following). Policies:
+#   'fast'    - fast stage only
+#   'cascade' - fast stage, CNN on demand
+#   'cnn'     - CNN only, on the full frame
+# Without the CNN model file, 'cascade' and 'cnn' fall back to 'fast'.
+DETECTION_POLICIES = ('fast', 'cascade', 'cnn')
+FAST_DETECTOR = os.environ.get('FAST_DETECTOR', 'hog')
+MEDIAPIPE_MIN_SCORE = 0.5
+CASCADE_MIN_SCORE = {'hog': 0.5, 'mediapipe': 0.75}
+CNN_ROI_PADDING = 0.5
+DUPLICATE_BOX_IOU = 0.5
+
+def _create_face_detector():
+    # Full-range model, for faces up to ~5 m from the camera
+    return mp.solutions.face_detection.FaceDetection(model_selection=1, min_detection_confidence=MEDIAPIPE_MIN_SCORE)
+
+face_detector_pool = ModelPool('mediapipe_detector', _create_face_detector)
+
+def _clip_box(box, h, w):
+    top, right, bottom, left = box
+    return (max(top, 0), min(right, w), min(bottom, h), max(left, 0))
+
+def _fast_detect(rgb):
+    # [(box, score)] from FAST_DETECTOR, in rgb's coordinates
+    h, w = rgb.shape[:2]
+    if FAST_DETECTOR == 'mediapipe':
+        with face_detector_pool.acquire() as fd, timed_inference('mediapipe_detector'):
+            res = fd.process(rgb)
+        found = []
+        for det in res.detections or []:
+            b = det.location_data.relative_bounding_box
+            top, left = int(b.ymin * h), int(b.xmin * w)
+            box = (top, left + int(b.width * w), top + int(b.height * h), left)
+            found.append((_clip_box(box, h, w), float(det.score[0])))
+        return found
+    with timed_inference('hog_detector'):
+        rects, scores, _ = face_recognition.api.face_detector.run(rgb, 1, 0.0)
+    return [(_clip_box((r.top(), r.right(), r.bottom(), r.left()), h, w), float(score))
+            for r, score in zip(rects, scores)]
+
+def _cnn_detect(rgb, top=0, left=0):
+    with cnn_detector_pool.acquire() as detector, timed_inference('cnn_detector'):
+        dets = detector(rgb, 1)  # Upsample the image once for better accuracy
+    h, w = rgb.shape[:2]
+    return [tuple(v + o for v, o in zip(_clip_box((d.rect.top(), d.rect.right(), d.rect.bottom(), d.rect.left()), h, w),
+                                        (top, left, top, left)))
+            for d in dets]
+
+# Frame preprocessing. Detection runs on a copy whose short side is
+# DETECT_SHORT_SIDE pixels; encoding and the mesh crops use the full
+# resolution frame. A FramePreprocessor keeps the RGB, downscaled and gray
+# images in buffers that are reused from frame to frame instead of
+# allocating new ones on every conversion. Gray frames alternate between two
+# buffers so the tracker's optical flow can still see the previous processed
+# frame; a received frame that is then skipped doesn't overwrite it.
+DETECT_SHORT_SIDE = int(os.environ.get('DETECT_SHORT_SIDE', 480))
+
+def detection_scale(shape, short_side=DETECT_SHORT_SIDE):
+    # Factor from full resolution to detection resolution (never upscales)
+    return min(1.0, short_side / min(shape[:2]))
+
+def _reuse(buf, shape):
+    return buf if buf is not None and buf.shape == shape else np.empty(shape, dtype=np.uint8)
+
+def downscale_for_detection(rgb, short_side=DETECT_SHORT_SIDE, dst=None):
+    # (rgb resized for detection, scale factor); rgb itself if it is already
+    # small enough. dst is an optional buffer to resize into.
+    scale = detection_scale(rgb.shape, short_side)
+    if scale >= 1.0:
+        return rgb, 1.0
+    h, w = rgb.shape[:2]
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    dst = _reuse(dst, (size[1], size[0], 3))
+    cv2.resize(rgb, size, dst=dst, interpolation=cv2.INTER_AREA)
+    return dst, scale
+
+class FramePreprocessor:
+    def __init__(self, short_side=DETECT_SHORT_SIDE):
+        self.short_side = short_side
+        self._rgb = None
+        self._small = None
+        self._scale = None
+        self._gray = [None, None]
+        self._gray_turn = 0
+
+    def rgb(self, img_bgr):
+        # RGB copy of img_bgr, valid until the next call
+        self._rgb = _reuse(self._rgb, img_bgr.shape)
+        cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB, dst=self._rgb)
+        self._scale = None
+        return self._rgb
+
+    def small(self):
+        # (downscaled copy of the last rgb() frame, scale factor)
+        if self._scale is None:
+            small, self._scale = downscale_for_detection(self._rgb, self.short_side, self._small)
+            if self._scale < 1.0:
+                self._small = small
+        return (self._small if self._scale < 1.0 else self._rgb), self._scale
+
+    def gray(self, img_bgr):
+        # Grayscale copy of img_bgr, valid until the next call; after
+        # advance() it stays valid until the next call but one
+        turn = self._gray_turn ^ 1
+        self._gray[turn] = _reuse(self._gray[turn], img_bgr.shape[:2])
+        cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY, dst=self._gray[turn])
+        return self._gray[turn]
+
+    def advance(self):
+        # Keep the last gray() frame as the previous frame for optical flow
+        self._gray_turn ^= 1
+
+def detect_faces(rgb, policy='cascade', expected_faces=0, timings=None, small=None, scale=1.0):
+    # Face boxes (top, right, bottom, left) in rgb's coordinates. small is
+    # rgb downscaled by scale for the fast stage (made here if not given).
+    # timings, if given, collects per-stage milliseconds and the number of
+    # escalations.
+    timings = timings if timings is not None else {}
+    use_cnn = policy in ('cascade', 'cnn') and os.path.exists(CNN_DETECTOR_FILE)
+    if policy == 'cnn' and use_cnn:
+        with timed_stage(timings, 'detect_cnn'):
+            return _cnn_detect(rgb)
+
+    h, w = rgb.shape[:2]
+    with timed_stage(timings, 'detect_fast'):
+        if small is None:
+            small, scale = downscale_for_detection(rgb)
+        found = [(tuple(int(round(v / scale)) for v in box), score) for box, score in _fast_detect(small)]
+    if not use_cnn:
+        return [box for box, _ in found]
+
+    if len(found) < expected_faces:
+        # The fast stage lost faces: look again with the CNN on the full frame
+        timings['escalations'] = timings.get('escalations', 0) + 1
+        with timed_stage(timings, 'detect_cnn'):
+            return _cnn_detect(rgb)
+
+    min_score = CASCADE_MIN_SCORE.get(FAST_DETECTOR, 0.5)
+    boxes = [box for box, score in found if score >= min_score]
+    for box, score in found:
+        if score >= min_score:
+            continue
+        # Weak detection: confirm (and tighten) it with the CNN on a padded
+        # crop around it
+        timings['escalations'] = timings.get('escalations', 0) + 1
+        top, right, bottom, left = box
+        pad = int(max(right - left, bottom - top) * CNN_ROI_PADDING)
+        top, right, bottom, left = _clip_box((top - pad, right + pad, bottom + pad, left - pad), h, w)
+        with timed_stage(timings, 'detect_cnn'):
+            confirmed = _cnn_detect(rgb[top:bottom, left:right], top, left)
+        for candidate in confirmed:
+            if not boxes or iou_matrix([candidate], boxes).max() < DUPLICATE_BOX_IOU:
+                boxes.append(candidate)
+    return boxes
+
+def warm_up_models(use_cnn=False):
+    # Build the models and run each once on a blank frame so the first real
+    # request doesn't pay for graph initialisation
+    blank = np.zeros((120, 160, 3), dtype=np.uint8)
+    with face_mesh_pool.acquire() as fm:
+        fm.process(blank)
+    face_recognition.face_locations(blank)
+    if FAST_DETECTOR == 'mediapipe':
+        with face_detector_pool.acquire() as fd:
+            fd.process(blank)
+    if use_cnn and os.path.exists(CNN_DETECTOR_FILE):
+        with cnn_detector_pool.acquire() as detector:
+            detector(blank, 0)
+    logging.info(f"Model warm-up done: {get_model_stats()}")
+
+def recognize_faces_and_liveness(img_bgr, detector_policy='cascade'):
     """
     Improved face detection and liveness detection method for better accuracy.
+    detector_policy: 'fast', 'cascade' or 'cnn' (see detect_faces)
     Returns a list of dicts: [{ 'name': str or None, 'liveness': bool, 'box': (top, right, bottom, left) }]
     """
-    known_encs, known_names = load_registered_faces()
     rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
 
-    # Use a more robust face detection model (e.g., dlib's CNN face detector)
-    cnn_face_detector = dlib.cnn_face_detection_model_v1('mmod_human_face_detector.dat')
-    face_locations = cnn_face_detector(rgb, 1)  # Upsample the image once for better accuracy
-
-    encs = []
-    refined_locations = []
-    for face in face_locations:
-        rect = face.rect
-        top, right, bottom, left = rect.top(), rect.right(), rect.bottom(), rect.left()
-        refined_locations.append((top, right, bottom, left))
-        face_enc = face_recognition.face_encodings(rgb, [(top, right, bottom, left)])
-        if face_enc:
-            encs.append(face_enc[0])
-
-    # Liveness detection setup
-    mp_fm = mp.solutions.face_mesh
+    refined_locations = detect_faces(rgb, detector_policy)
+    with timed_inference('face_encoder'):
+        encs = encoding_batcher.encode(rgb, refined_locations)
+    matches = match_faces(encs)
+
+    # Liveness detection, on each face's own crop
+    with face_mesh_pool.acquire() as fm, timed_inference('face_mesh'):
+        face_landmarks_list = roi_landmarks(fm, rgb, refined_locations)
+
     results = []
-    with mp_fm.FaceMesh(static_image_mode=True, max_num_faces=10, refine_landmarks=True) as fm:
-        fm_res = fm.process(rgb)
-        face_landmarks_list = fm_res.multi_face_landmarks if fm_res.multi_face_landmarks else []
-
-        for i, (enc, loc) in enumerate(zip(encs, refined_locations)):
-            name = None
-            if known_encs:
-                idx = np.argmin(face_recognition.face_distance(known_encs, enc))
-                if face_recognition.compare_faces(known_encs, enc)[idx]:
-                    name = known_names[idx]
-            # Liveness: check blink for this face (if landmarks available)
-            liveness = False
-            if i < len(face_landmarks_list):
-                liveness = is_blinking(face_landmarks_list[i])
-            results.append({'name': name, 'liveness': bool(liveness), 'box': loc})
+    for match, loc, landmarks in zip(matches, refined_locations, face_landmarks_list):
+        # Liveness: check blink for this face (if landmarks available)
+        liveness = False
+        if landmarks is not None:
+            liveness = is_blinking(landmarks)
+        results.append({'name': match['name'], 'distance': match['distance'],
+                        'liveness': bool(liveness), 'box': loc})
     return results
 
-# Eye aspect ratio for blink detection
+# Liveness landmarks are computed per face: the mesh runs on a square,
+# padded crop around each detector box, one face per crop. There is no cap
+# on faces per frame, each mesh call sees a small image, and the landmarks
+# always belong to the box they were computed for. Square crops also make
+# the normalised landmark coordinates isotropic, so EAR is a true ratio.
+MESH_ROI_PADDING = 0.25
+MESH_ROI_SIZE = 256
+
+def face_roi(rgb, box, padding=MESH_ROI_PADDING, size=MESH_ROI_SIZE):
+    # Square crop around box, padded by a fraction of the box on each side
+    # (black beyond the frame edge) and downscaled to at most size pixels
+    h, w = rgb.shape[:2]
+    top, right, bottom, left = box
+    side = int(max(right - left, bottom - top) * (1 + 2 * padding))
+    y0 = (top + bottom) // 2 - side // 2
+    x0 = (left + right) // 2 - side // 2
+    sy0, sx0 = max(y0, 0), max(x0, 0)
+    sy1, sx1 = min(y0 + side, h), min(x0 + side, w)
+    if side <= 0 or sy1 <= sy0 or sx1 <= sx0:
+        return None
+    crop = np.zeros((side, side, 3), dtype=np.uint8)
+    crop[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = rgb[sy0:sy1, sx0:sx1]
+    if side > size:
+        crop = cv2.resize(crop, (size, size), interpolation=cv2.INTER_AREA)
+    return crop
+
+def roi_landmarks(fm, rgb, boxes):
+    # Mesh landmarks (or None) for each box, run back to back on one mesh
+    # instance over the boxes' crops
+    landmarks = []
+    for box in boxes:
+        crop = face_roi(rgb, box)
+        res = fm.process(crop) if crop is not None else None
+        landmarks.append(res.multi_face_landmarks[0] if res is not None and res.multi_face_landmarks else None)
+    return landmarks
+
+# Eye aspect ratio for blink detection. Landmarks are copied out of the
+# MediaPipe objects once into arrays and EARs are computed for all faces
+# (and frames) in one expression.
 LEFT_EYE_IDX = [33, 160, 158, 133, 153, 144]
 RIGHT_EYE_IDX = [362, 385, 387, 263, 373, 380]
+EYE_IDX = np.array([LEFT_EYE_IDX, RIGHT_EYE_IDX])
+# landmarks_to_array(..., EYE_POINTS) keeps only the eye points, in EYE_IDX
+# order; EYE_POINT_IDX indexes those reduced arrays
+EYE_POINTS = EYE_IDX.ravel()
+EYE_POINT_IDX = np.arange(EYE_POINTS.size).reshape(EYE_IDX.shape)
+
+def landmarks_to_array(landmark_lists, indices=None):
+    # (faces, points, 3) float32 array of x, y, z from MediaPipe landmark
+    # lists, NaN for entries that are None. indices limits the points copied.
+    count = len(indices) if indices is not None else None
+    arrays = []
+    for landmarks in landmark_lists:
+        if landmarks is None:
+            arrays.append(None)
+            continue
+        points = landmarks.landmark
+        if indices is not None:
+            points = [points[i] for i in indices]
+        arrays.append(np.array([(p.x, p.y, p.z) for p in points], dtype=np.float32))
+        count = len(arrays[-1])
+    if count is None:
+        return np.empty((len(arrays), 0, 3), dtype=np.float32)
+    empty = np.full((count, 3), np.nan, dtype=np.float32)
+    return np.stack([a if a is not None else empty for a in arrays]) if arrays else np.empty((0, count, 3), np.float32)
 
-def eye_aspect_ratio(landmarks, idx_list):
-    pts = np.array([[landmarks[i].x, landmarks[i].y] for i in idx_list])
-    A = np.linalg.norm(pts[1] - pts[5])
-    B = np.linalg.norm(pts[2] - pts[4])
-    C = np.linalg.norm(pts[0] - pts[3])
-    return (A + B) / (2.0 * C)
+def eye_aspect_ratios(points, eye_idx=EYE_IDX):
+    # Mean EAR of both eyes for landmark arrays of shape (..., points, 2 or 3)
+    eyes = points[..., eye_idx, :2]  # (..., eye, 6, 2)
+    A = np.linalg.norm(eyes[..., 1, :] - eyes[..., 5, :], axis=-1)
+    B = np.linalg.norm(eyes[..., 2, :] - eyes[..., 4, :], axis=-1)
+    C = np.linalg.norm(eyes[..., 0, :] - eyes[..., 3, :], axis=-1)
+    return ((A + B) / (2.0 * C)).mean(axis=-1)
 
 def is_blinking(landmarks):
-    leftEAR = eye_aspect_ratio(landmarks.landmark, LEFT_EYE_IDX)
-    rightEAR = eye_aspect_ratio(landmarks.landmark, RIGHT_EYE_IDX)
-    ear = (leftEAR + rightEAR) / 2.0
-    EAR_THRESH = 0.25
-    return ear < EAR_THRESH
+    ear = eye_aspect_ratios(landmarks_to_array([landmarks], EYE_POINTS), EYE_POINT_IDX)[0]
+    return ear < EAR_THRESH - EAR_HYSTERESIS
+
+def detect_blinks(ears, thresholds):
+    # ears: (faces, frames) EAR history, NaN where a face had no landmarks.
+    # thresholds: scalar or (faces,). A face blinked if its eyes were seen
+    # open, then closed, then open again. Open and closed must clear the
+    # threshold by EAR_HYSTERESIS, so landmark jitter around it isn't a blink.
+    thresholds = np.asarray(thresholds, dtype=np.float32).reshape(-1, 1)
+    with np.errstate(invalid='ignore'):
+        is_open = ears > thresholds + EAR_HYSTERESIS
+        is_closed = ears < thresholds - EAR_HYSTERESIS
+    closed_after_open = is_closed & np.logical_or.accumulate(is_open, axis=1)
+    return (is_open & np.logical_or.accumulate(closed_after_open, axis=1)).any(axis=1)
+
+# Per-user blink thresholds. Open-eye EAR varies between people, so each
+# user's threshold is a fraction of their own open-eye level, learned from
+# previous sequences (a running average of the 90th percentile EAR). Users
+# without history use EAR_THRESH.
+# EARs are true aspect ratios of square mesh crops; the thresholds that were
+# tuned on frame-normalised coordinates (0.25 on 4:3 frames) are scaled to
+# match.
+EAR_THRESH = 0.19
+EAR_HYSTERESIS = 0.02
+EAR_BLINK_RATIO = 0.75
+EAR_MIN_THRESH = 0.11
+EAR_MAX_THRESH = 0.23
+EAR_BASELINE_WEIGHT = 0.2
+EAR_MIN_SAMPLES = 3
+
+_ear_lock = threading.Lock()
+_ear_baselines = {}
+
+def blink_thresholds(names):
+    with _ear_lock:
+        baselines = [_ear_baselines.get(name) for name in names]
+    return np.array([EAR_THRESH if b is None else min(max(b * EAR_BLINK_RATIO, EAR_MIN_THRESH), EAR_MAX_THRESH)
+                     for b in baselines], dtype=np.float32)
+
+def update_ear_baseline(name, ears):
+    ears = np.asarray(ears, dtype=np.float32)
+    ears = ears[np.isfinite(ears)]
+    if ears.size < EAR_MIN_SAMPLES:
+        return
+    level = float(np.percentile(ears, 90))
+    with _ear_lock:
+        baseline = _ear_baselines.get(name)
+        _ear_baselines[name] = level if baseline is None else baseline + EAR_BASELINE_WEIGHT * (level - baseline)
+
+# Adaptive sequence evaluation: frames in which none of the watched faces
+# changed since the last processed frame are skipped, and the sequence stops
+# once every recognised face has blinked. Each face is compared on its own
+# thumbnail, so one face blinking in a crowded frame is never averaged away.
+# A face that is not recognised yet may be on its first, blurry encoding, so
+# the sequence only stops early once every unrecognised face has been
+# encoded again, or after EARLY_EXIT_MIN_FRAMES processed frames.
+DIFF_THUMB_SIZE = 48
+DUPLICATE_PIXEL_DELTA = 12
+DUPLICATE_MAX_CHANGED = 0.002
+EARLY_EXIT_MIN_FRAMES = 15
+
+def face_thumbnails(gray, boxes):
+    # Small copy of each padded face box of a grayscale frame, shape
+    # (faces, size, size)
+    h, w = gray.shape[:2]
+    thumbs = np.empty((len(boxes), DIFF_THUMB_SIZE, DIFF_THUMB_SIZE), dtype=np.uint8)
+    for i, (top, right, bottom, left) in enumerate(boxes):
+        pad_y, pad_x = (bottom - top) // 10, (right - left) // 10
+        roi = gray[max(0, top - pad_y):min(h, bottom + pad_y), max(0, left - pad_x):min(w, right + pad_x)]
+        if roi.size == 0:
+            roi = gray
+        thumbs[i] = cv2.resize(roi, (DIFF_THUMB_SIZE, DIFF_THUMB_SIZE), interpolation=cv2.INTER_AREA)
+    return thumbs
+
+def changed_faces(thumbs, prev_thumbs):
+    # Per face: did enough of its thumbnail change?
+    changed = cv2.absdiff(thumbs, prev_thumbs) > DUPLICATE_PIXEL_DELTA
+    return np.count_nonzero(changed.reshape(len(thumbs), -1), axis=1) >= DUPLICATE_MAX_CHANGED * changed[0].size
 
-def recognize_faces_and_liveness_sequence(imgs):
+def _enrolment_candidate(track):
+    # With AUTO_ENROL on, confident matches carry their encoding (as
+    # 'encoding') so the caller can pass it to auto_enrol once the face is
+    # marked; callers must remove it before sending results to clients
+    if AUTO_ENROL and track.name and track.encoding is not None and track.distance <= AUTO_ENROL_DISTANCE:
+        return {'encoding': track.encoding}
+    return {}
+
+class LivenessSequence:
     """
-    imgs: list of BGR images (frames)
-    Returns a list of dicts: [{ 'name': str or None, 'liveness': bool, 'box': (top, right, bottom, left) }]
+    Recognition and blink-liveness state for one stream of frames, fed one
+    frame at a time. Faces are followed with a FaceTracker: the detector
+    runs on the first frame and then every few frames, and a face is only
+    encoded when its track is new or its identity uncertain. Landmarks come
+    from each pending track's own crop.
+
+    Used for whole uploaded sequences (recognize_faces_and_liveness_sequence)
+    and for live sessions, which pass live=True: tracks that leave the frame
+    are forgotten and EAR histories are capped at max_history frames.
     """
-    if not imgs:
-        return []
-    # Use the first frame to detect faces and get locations
-    rgb0 = cv2.cvtColor(imgs[0], cv2.COLOR_BGR2RGB)
-    face_locations = face_recognition.face_locations(rgb0)
-    encs = face_recognition.face_encodings(rgb0, face_locations)
-    known_encs, known_names = load_registered_faces()
-    # For each face, track EAR across frames
-    face_ears = [[] for _ in face_locations]
-    for img in imgs:
-        rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        # Use mediapipe face mesh to get landmarks for all faces
-        mp_fm = mp.solutions.face_mesh
-        with mp_fm.FaceMesh(static_image_mode=True, max_num_faces=10, refine_landmarks=True) as fm:
-            fm_res = fm.process(rgb)
-            face_landmarks_list = fm_res.multi_face_landmarks if fm_res.multi_face_landmarks else []
-            for i, landmarks in enumerate(face_landmarks_list):
-                leftEAR = eye_aspect_ratio(landmarks.landmark, LEFT_EYE_IDX)
-                rightEAR = eye_aspect_ratio(landmarks.landmark, RIGHT_EYE_IDX)
-                ear = (leftEAR + rightEAR) / 2.0
-                if i < len(face_ears):
-                    face_ears[i].append(ear)
-    results = []
-    for i, (enc, loc) in enumerate(zip(encs, face_locations)):
-        name = None
-        if known_encs:
-            idx = np.argmin(face_recognition.face_distance(known_encs, enc))
-            if face_recognition.compare_faces(known_encs, enc)[idx]:
-                name = known_names[idx]
-        # Liveness: check if EAR drops below threshold and rises (blink)
-        ears = face_ears[i] if i < len(face_ears) else []
-        EAR_THRESH = 0.25
-        blinked = False
-        for j in range(1, len(ears)):
-            if ears[j-1] > EAR_THRESH and ears[j] < EAR_THRESH:
-                # eye closed
-                for k in range(j+1, len(ears)):
-                    if ears[k] > EAR_THRESH:
-                        blinked = True
-                        break
-            if blinked:
+
+    def __init__(self, detector_policy='cascade', live=False, max_history=None):
+        self.detector_policy = detector_policy
+        self.live = live
+        self.max_history = max_history
+        self.tracker = FaceTracker(reverify_every=REVERIFY_EVERY if live else None)
+        self.preprocessor = FramePreprocessor()
+        self.tracks = {}
+        # EAR history per track id, NaN for frames without landmarks
+        self.ear_history = {}
+        self.blinked = set()
+        # Only recognised faces need a liveness decision; unknown faces can't
+        # be marked either way.
+        self.pending = set()
+        self.received = self.processed = self.skipped = self.detections = 0
+        self.encodes = {}   # track id -> times encoded
+        self.timings = {}
+        self._prev_thumbs = {}   # track id -> thumbnail at the last processed frame
+
+    @property
+    def done(self):
+        # Every recognised face seen so far has blinked, and every face still
+        # unrecognised has had a second chance at an encoding
+        if self.processed == 0 or self.pending:
+            return False
+        if self.processed >= EARLY_EXIT_MIN_FRAMES:
+            return True
+        tracks = self.tracker.tracks
+        return bool(tracks) and all(t.name or self.encodes.get(t.id, 0) >= 2 for t in tracks)
+
+    def feed(self, img, fm):
+        # Process one BGR frame with mesh instance fm. Returns the events it
+        # decided: {'event': 'face', ...} when a track gets an identity (or a
+        # new one) and {'event': 'liveness', ...} when a recognised face blinks.
+        tracker = self.tracker
+        events = []
+        self.received += 1
+        gray = self.preprocessor.gray(img)
+        if tracker.tracks:
+            # Watch the faces awaiting a blink, or every face if none is;
+            # skip the frame only if none of them changed
+            watched = [t for t in tracker.tracks if t.id in self.pending] or tracker.tracks
+            thumbs = face_thumbnails(gray, [t.box for t in watched])
+            if all(t.id in self._prev_thumbs for t in watched):
+                prev = np.stack([self._prev_thumbs[t.id] for t in watched])
+                if not changed_faces(thumbs, prev).any():
+                    self.skipped += 1
+                    return events
+            self._prev_thumbs = {t.id: thumb for t, thumb in zip(watched, thumbs)}
+        self.processed += 1
+        self.preprocessor.advance()
+        rgb = self.preprocessor.rgb(img)
+        tracker.next_frame(gray)
+        if tracker.due_for_detection():
+            self.detections += 1
+            small, scale = self.preprocessor.small()
+            boxes = detect_faces(rgb, self.detector_policy, len(tracker.tracks), self.timings, small, scale)
+            to_encode = tracker.update(boxes)
+            if to_encode:
+                with timed_stage(self.timings, 'encode'), timed_inference('face_encoder'):
+                    encs = encoding_batcher.encode(rgb, [t.box for t in to_encode])
+                for track, enc, match in zip(to_encode, encs, match_faces(encs)):
+                    if self.live and track.name and match['name'] != track.name:
+                        # Someone else is in this face's place now: follow
+                        # them on a new track so they can't inherit its blink
+                        track = tracker.reset(track)
+                    self.encodes[track.id] = self.encodes.get(track.id, 0) + 1
+                    previous = track.name if track.id in self.tracks else False
+                    track.set_match(match, enc)
+                    self.tracks[track.id] = track
+                    if track.name != previous:
+                        events.append({'event': 'face', 'track_id': track.id, 'name': track.name,
+                                       'distance': track.distance, 'box': track.box})
+                    if track.name and track.id not in self.blinked:
+                        self.pending.add(track.id)
+            # A track that left the frame can't blink any more
+            current = {t.id for t in tracker.tracks}
+            self.pending &= current
+            if self.live:
+                for track_id in [i for i in self.tracks if i not in current]:
+                    self._forget(track_id)
+        pending_tracks = [t for t in tracker.tracks if t.id in self.pending]
+        if not pending_tracks:
+            return events
+        with timed_stage(self.timings, 'mesh'), timed_inference('face_mesh'):
+            face_landmarks_list = roi_landmarks(fm, rgb, [t.box for t in pending_tracks])
+        ears = eye_aspect_ratios(landmarks_to_array(face_landmarks_list, EYE_POINTS), EYE_POINT_IDX)
+        for track, ear in zip(pending_tracks, ears):
+            history = self.ear_history.setdefault(track.id, [])
+            history.append(ear)
+            if self.max_history and len(history) > self.max_history:
+                del history[:-self.max_history]
+        # Blink check over the whole history of every pending track at once
+        histories = [self.ear_history[t.id] for t in pending_tracks]
+        matrix = np.full((len(histories), max(map(len, histories))), np.nan, dtype=np.float32)
+        for row, history in zip(matrix, histories):
+            row[:len(history)] = history
+        done = detect_blinks(matrix, blink_thresholds([t.name for t in pending_tracks]))
+        for track, is_done in zip(pending_tracks, done):
+            if is_done:
+                self.blinked.add(track.id)
+                self.pending.discard(track.id)
+                events.append({'event': 'liveness', 'track_id': track.id, 'name': track.name,
+                               'distance': track.distance, 'box': track.box,
+                               **_enrolment_candidate(track)})
+        return events
+
+    def _forget(self, track_id):
+        track = self.tracks.pop(track_id)
+        history = self.ear_history.pop(track_id, None)
+        if track.name and history:
+            update_ear_baseline(track.name, history)
+        self.blinked.discard(track_id)
+        self.encodes.pop(track_id, None)
+
+    def stats(self, early_exit=False):
+        timings = dict(self.timings)
+        return {'frames_received': self.received, 'frames_processed': self.processed,
+                'frames_skipped': self.skipped, 'detections': self.detections,
+                'escalations': timings.pop('escalations', 0), 'early_exit': early_exit,
+                'timings_ms': {stage: round(ms, 2) for stage, ms in timings.items()}}
+
+    def finish(self):
+        # One result per track; also folds the EAR histories into the users'
+        # blink baselines
+        results = []
+        for track_id, track in sorted(self.tracks.items()):
+            if track.name and track_id in self.ear_history:
+                update_ear_baseline(track.name, self.ear_history[track_id])
+            # Liveness: the EAR dropped below threshold and rose again (blink)
+            live = track_id in self.blinked
+            results.append({'track_id': track_id, 'name': track.name, 'distance': track.distance,
+                            'liveness': live, 'box': track.box,
+                            **(_enrolment_candidate(track) if live else {})})
+        return results
+
+def recognize_faces_and_liveness_sequence(imgs, stats=None, detector_policy='cascade'):
+    """
+    imgs: list (or any iterable) of BGR images (frames), in capture order
+    stats: optional dict, filled with frames_received / frames_processed /
+           frames_skipped / detections / escalations, per-stage timings_ms
+           and whether the sequence exited early
+    detector_policy: 'fast', 'cascade' or 'cnn' (see detect_faces)
+    Returns a list of dicts, one per tracked face:
+    [{ 'track_id': int, 'name': str or None, 'liveness': bool, 'box': (top, right, bottom, left) }]
+    plus 'encoding' for confident live matches when AUTO_ENROL is on
+    """
+    sequence = LivenessSequence(detector_policy)
+    early_exit = False
+    with face_mesh_pool.acquire() as fm:
+        for img in imgs:
+            if sequence.done:
+                early_exit = True
                 break
-        results.append({'name': name, 'liveness': bool(blinked), 'box': loc})
-    return results
\ No newline at end of file
+            sequence.feed(img, fm)
+    if stats is not None:
+        stats.update(sequence.stats(early_exit))
+    return sequence.finish()
@@ -0,0 +1,81 @@
+"""
+One-shot import of the legacy user stores into the users table.
+
+Older versions kept users in three places: the users table, user_data.csv
+(name, email, roll number) and one JPEG per user in registered_faces/. The
+users table is now the only roster. This script copies every user found in
+the CSV or the image directory into it, computing face encodings for the
+images, so the old files are no longer needed. Users already in the table
+are never overwritten; only a missing face image is filled in. Running it
+again is harmless. Example:
+
+    python import_legacy_users.py --csv user_data.csv --faces registered_faces
+"""
+import argparse
+import csv
+import os
+
+from face_utils import REGISTERED_DIR, database, fetch_face_image, get_roster, save_user_data
+
+
+def read_legacy_csv(path):
+    # {name: (email, rollno)}; later rows win, the header row is skipped
+    users = {}
+    if not os.path.exists(path):
+        return users
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 3 or not row[0].strip() or row[0] == 'Name':
+                continue
+            users[row[0].strip()] = (row[1].strip(), row[2].strip())
+    return users
+
+
+def read_legacy_faces(path):
+    # {name: jpeg bytes} from <name>.jpg files
+    faces = {}
+    if not os.path.isdir(path):
+        return faces
+    for fn in sorted(os.listdir(path)):
+        name, ext = os.path.splitext(fn)
+        if ext.lower() == '.jpg':
+            with open(os.path.join(path, fn), 'rb') as f:
+                faces[name] = f.read()
+    return faces
+
+
+def import_legacy_users(csv_path='user_data.csv', faces_dir=REGISTERED_DIR):
+    # Returns counts of users added, images filled in and users skipped
+    legacy = read_legacy_csv(csv_path)
+    faces = read_legacy_faces(faces_dir)
+    roster = dict(get_roster())
+    added = filled = skipped = 0
+    for name in sorted(set(legacy) | set(faces)):
+        face_image = faces.get(name)
+        if name in roster:
+            if face_image and fetch_face_image(name) is None:
+                email, rollno, class_name = roster[name]
+                save_user_data(name, email, rollno, face_image, class_name)
+                filled += 1
+            else:
+                skipped += 1
+            continue
+        email, rollno = legacy.get(name, ('', ''))
+        save_user_data(name, email, rollno, face_image)
+        added += 1
+    return {'added': added, 'faces_filled': filled, 'skipped': skipped}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--csv', default='user_data.csv')
+    parser.add_argument('--faces', default=REGISTERED_DIR)
+    args = parser.parse_args()
+    counts = import_legacy_users(args.csv, args.faces)
+    print(f"Added {counts['added']} user(s), filled in {counts['faces_filled']} face image(s), "
+          f"skipped {counts['skipped']} already imported")
+    database.close_all()
+
+
+if __name__ == '__main__':
+    main()
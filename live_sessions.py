@@ -0,0 +1,129 @@
+import queue
+import secrets
+import threading
+import time
+from collections import deque
+
+from recognition_service import recognition_service
+
+# Live attendance sessions.
+#
+# Instead of uploading bursts of frames, a kiosk opens a session and pushes
+# single frames as it captures them. Each session keeps its own
+# LivenessSequence (tracker, EAR histories, blink state), so every frame is
+# processed as soon as it arrives and recognition / liveness / marked events
+# are published the moment they are decided. Subscribers (the kiosk's
+# event stream) receive them through a queue; recent events are replayed to
+# new subscribers so nothing is lost while the stream is connecting.
+#
+# The LivenessSequence lives in the recognition_service worker the session
+# is pinned to, and each frame is recognised there, holding a slot like an
+# uploaded sequence (so a saturated service refuses it with 429). The web
+# process only keeps the subscribers and the event backlog. A session
+# handles one frame at a time; clients send the next frame after the
+# previous one returns.
+
+LIVE_MAX_SESSIONS = 8
+LIVE_IDLE_SECONDS = 60
+LIVE_MAX_FPS = 10
+LIVE_MAX_HISTORY = 90   # EAR frames kept per face
+LIVE_EVENT_BACKLOG = 50
+
+
+class LiveSession:
+    def __init__(self, session_id, detector_policy='cascade'):
+        self.id = session_id
+        self.detector_policy = detector_policy
+        self.last_seen = time.monotonic()
+        self.closed = False
+        self._frame_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._recent = deque(maxlen=LIVE_EVENT_BACKLOG)
+
+    def process_frame(self, img):
+        # (events decided by this frame, current track boxes), or None if the
+        # session is still busy with the previous one. Raises ServiceBusy /
+        # ServiceUnavailable like recognition_service.recognize_sequence.
+        if not self._frame_lock.acquire(blocking=False):
+            return None
+        try:
+            self.last_seen = time.monotonic()
+            return recognition_service.live_frame(self.id, img, self.detector_policy, LIVE_MAX_HISTORY)
+        finally:
+            self._frame_lock.release()
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=LIVE_EVENT_BACKLOG * 2)
+        with self._lock:
+            for event in self._recent:
+                q.put_nowait(event)
+            self._subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+    def publish(self, events):
+        with self._lock:
+            for event in events:
+                self._recent.append(event)
+                for q in self._subscribers:
+                    try:
+                        q.put_nowait(event)
+                    except queue.Full:
+                        pass  # a stalled subscriber misses events rather than blocking frames
+
+    def close(self):
+        # Ends every subscriber's stream and drops the recognition state
+        recognition_service.close_session(self.id)
+        with self._lock:
+            self.closed = True
+            for q in self._subscribers:
+                try:
+                    q.put_nowait(None)
+                except queue.Full:
+                    pass
+
+
+class LiveSessionManager:
+    def __init__(self, max_sessions=LIVE_MAX_SESSIONS, idle_seconds=LIVE_IDLE_SECONDS):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        # Caller must hold _lock
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            if now - session.last_seen > self.idle_seconds:
+                del self._sessions[session_id]
+                session.close()
+
+    def create(self, detector_policy='cascade'):
+        # Returns the new session, or None when the session limit is reached
+        with self._lock:
+            self._expire()
+            if len(self._sessions) >= self.max_sessions:
+                return None
+            session = LiveSession(secrets.token_urlsafe(12), detector_policy)
+            self._sessions[session.id] = session
+            return session
+
+    def get(self, session_id):
+        with self._lock:
+            self._expire()
+            return self._sessions.get(session_id)
+
+    def close(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            session.close()
+        return session is not None
+
+
+live_sessions = LiveSessionManager()
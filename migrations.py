@@ -0,0 +1,186 @@
+import logging
+
+# Versioned schema migrations.
+#
+# The schema version is stored in SQLite's PRAGMA user_version. Each migration
+# runs once, in order, inside a transaction, and bumps the version. To change
+# the schema append a new function to MIGRATIONS; never edit one that has
+# already shipped.
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def m001_base_tables(conn):
+    # Tables as created by the original init_db, plus the columns that older
+    # databases had to ALTER in by hand
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            name TEXT PRIMARY KEY,
+            email TEXT NOT NULL,
+            rollno TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS attendance (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            status TEXT NOT NULL,
+            FOREIGN KEY (name) REFERENCES users (name)
+        )
+    ''')
+    columns = _columns(conn, 'users')
+    for column, col_type in (('face_image', 'BLOB'),
+                             ('face_encoding', 'BLOB'),
+                             ('encoding_version', 'TEXT')):
+        if column not in columns:
+            conn.execute(f'ALTER TABLE users ADD COLUMN {column} {col_type}')
+
+
+def m002_unique_daily_attendance(conn):
+    # One attendance row per user per day: keep the latest of any duplicates
+    conn.execute('''
+        DELETE FROM attendance WHERE id NOT IN (
+            SELECT MAX(id) FROM attendance GROUP BY name, date
+        )
+    ''')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_attendance_name_date ON attendance (name, date)')
+
+
+def m003_integer_days_and_indexes(conn):
+    # Store the day as an integer (YYYYMMDD) and index it both ways: by day
+    # for the dashboard/status queries, by name for per-student history.
+    # The text date column is kept for display and export.
+    if 'day' not in _columns(conn, 'attendance'):
+        conn.execute('ALTER TABLE attendance ADD COLUMN day INTEGER')
+    conn.execute("UPDATE attendance SET day = CAST(REPLACE(date, '-', '') AS INTEGER) WHERE day IS NULL")
+    conn.execute('DROP INDEX IF EXISTS idx_attendance_name_date')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_attendance_name_day ON attendance (name, day)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_attendance_day_name ON attendance (day, name)')
+
+
+def m004_daily_aggregates(conn):
+    # Classes on users, first-seen time and class on each daily attendance
+    # row, and per day / per class totals kept up to date on every mark
+    if 'class_name' not in _columns(conn, 'users'):
+        conn.execute("ALTER TABLE users ADD COLUMN class_name TEXT NOT NULL DEFAULT ''")
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_class ON users (class_name)')
+    columns = _columns(conn, 'attendance')
+    if 'first_seen' not in columns:
+        conn.execute('ALTER TABLE attendance ADD COLUMN first_seen TEXT')
+    if 'class_name' not in columns:
+        conn.execute("ALTER TABLE attendance ADD COLUMN class_name TEXT NOT NULL DEFAULT ''")
+    conn.execute("UPDATE attendance SET first_seen = time WHERE status = 'present' AND first_seen IS NULL")
+    conn.execute('''
+        UPDATE attendance SET class_name = COALESCE(
+            (SELECT class_name FROM users WHERE users.name = attendance.name), '')
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS attendance_daily_summary (
+            day INTEGER NOT NULL,
+            class_name TEXT NOT NULL,
+            enrolled INTEGER NOT NULL,
+            present_count INTEGER NOT NULL DEFAULT 0,
+            absent_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, class_name)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('DELETE FROM attendance_daily_summary')
+    conn.execute('''
+        INSERT INTO attendance_daily_summary (day, class_name, enrolled, present_count, absent_count)
+        SELECT a.day, a.class_name,
+               (SELECT COUNT(*) FROM users u WHERE u.class_name = a.class_name),
+               SUM(a.status = 'present'), SUM(a.status = 'absent')
+        FROM attendance a GROUP BY a.day, a.class_name
+    ''')
+
+
+def m005_user_embeddings(conn):
+    # Several embeddings per user: one per registration photo (the photo is
+    # kept so it can be re-encoded when the encoder changes) plus frames
+    # auto-enrolled from confident live matches. Seeded from each user's
+    # current photo and encoding.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_embeddings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            encoding BLOB,
+            encoding_version TEXT NOT NULL DEFAULT '',
+            source TEXT NOT NULL,
+            face_image BLOB,
+            distance REAL,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_embeddings_name ON user_embeddings (name)')
+    conn.execute('''
+        INSERT INTO user_embeddings (name, encoding, encoding_version, source, face_image, created_at)
+        SELECT name, face_encoding, COALESCE(encoding_version, ''), 'register', face_image, datetime('now')
+        FROM users WHERE face_image IS NOT NULL OR face_encoding IS NOT NULL
+    ''')
+
+
+def m006_drop_attendance_stats(conn):
+    # Migration 3 used to ANALYZE attendance while the table was still small.
+    # Nothing refreshed those statistics, so once the table grew the planner
+    # kept scanning it for per-day queries instead of using
+    # idx_attendance_day_name. Without statistics it picks the index.
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+        conn.execute("DELETE FROM sqlite_stat1 WHERE tbl = 'attendance'")
+        conn.execute('ANALYZE sqlite_master')  # reload the statistics
+
+
+def m007_email_queue(conn):
+    # The notification queue (see notifications.py). Older databases already
+    # have the table, created by NotificationQueue itself, without the
+    # lease_until column used to claim messages.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS email_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            lease_until REAL
+        )
+    ''')
+    if 'lease_until' not in _columns(conn, 'email_queue'):
+        conn.execute('ALTER TABLE email_queue ADD COLUMN lease_until REAL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_email_queue_due ON email_queue (status, next_attempt_at)')
+
+
+MIGRATIONS = [
+    m001_base_tables,
+    m002_unique_daily_attendance,
+    m003_integer_days_and_indexes,
+    m004_daily_aggregates,
+    m005_user_embeddings,
+    m006_drop_attendance_stats,
+    m007_email_queue,
+]
+
+
+def schema_version(database):
+    return database.query_one('PRAGMA user_version')[0]
+
+
+def apply_migrations(database, migrations=MIGRATIONS):
+    # Returns the schema version after applying any pending migrations
+    # Take the write lock up front so two processes can't migrate at once
+    with database.transaction(immediate=True) as conn:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, migration in enumerate(migrations, start=1):
+            if number <= version:
+                continue
+            logging.info(f"Applying schema migration {number}: {migration.__name__}")
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+            version = number
+    return version
@@ -0,0 +1,209 @@
+import logging
+import os
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+
+# Background email notifications.
+#
+# Messages are written to an SQLite-backed queue (so nothing is lost if the
+# server restarts) and delivered by a single worker thread that keeps one SMTP
+# session open and sends many messages per login. Failed sends are retried
+# with exponential backoff, and delivery is rate limited to stay under the
+# provider's sending limits. Each message is claimed (status 'sending' with
+# a lease) before it is sent, so a second worker never sends it too; if a
+# worker dies mid-send the lease expires and the message is retried.
+# The email_queue table is created by the schema migrations (migrations.py).
+#
+# To try it against a local stand-in server instead of Gmail:
+#
+#     python -m aiosmtpd -n -l localhost:1025
+#     SMTP_HOST=localhost SMTP_PORT=1025 SMTP_STARTTLS=0 SMTP_USER= python app.py
+
+SMTP_HOST = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', '587'))
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') != '0'
+SENDER_EMAIL = os.environ.get('SMTP_SENDER', 'abhaychauhan5051@gmail.com')  # Replace with your email
+SMTP_USER = os.environ.get('SMTP_USER', SENDER_EMAIL)
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', 'csvklapxmsnhubxj')  # Replace with your email password
+
+MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 10
+RETRY_MAX_SECONDS = 30 * 60
+MAX_PER_MINUTE = 60
+BATCH_SIZE = 20
+SESSION_IDLE_SECONDS = 60
+LEASE_SECONDS = 120
+
+
+class SMTPSession:
+    """A long-lived, lazily (re)connected SMTP connection."""
+
+    def __init__(self, host, port, use_starttls, username, password, timeout=30):
+        self.host = host
+        self.port = port
+        self.use_starttls = use_starttls
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self._server = None
+        self._last_used = 0.0
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_starttls:
+            server.starttls()
+        if self.username:
+            server.login(self.username, self.password)
+        self._server = server
+
+    def send(self, msg):
+        if self._server is None:
+            self._connect()
+        try:
+            self._server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped an idle session; reconnect once and resend
+            self.close()
+            self._connect()
+            self._server.send_message(msg)
+        self._last_used = time.monotonic()
+
+    def close_if_idle(self, idle_seconds):
+        if self._server is not None and time.monotonic() - self._last_used > idle_seconds:
+            self.close()
+
+    def close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._server = None
+
+
+class NotificationQueue:
+    def __init__(self, database, session=None, sender=SENDER_EMAIL, max_per_minute=MAX_PER_MINUTE,
+                 max_attempts=MAX_ATTEMPTS, retry_base=RETRY_BASE_SECONDS, batch_size=BATCH_SIZE):
+        self.database = database
+        self.session = session or SMTPSession(SMTP_HOST, SMTP_PORT, SMTP_STARTTLS, SMTP_USER, SMTP_PASSWORD)
+        self.sender = sender
+        self.min_interval = 60.0 / max_per_minute if max_per_minute else 0.0
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.batch_size = batch_size
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_send = 0.0
+
+    def enqueue(self, recipient, subject, body):
+        now = time.time()
+        self.database.execute('''
+            INSERT INTO email_queue (recipient, subject, body, next_attempt_at, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (recipient, subject, body, now, now))
+        self._wake.set()
+
+    def pending_count(self):
+        return self.database.query_one("SELECT COUNT(*) FROM email_queue WHERE status IN ('pending', 'sending')")[0]
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='email-notifications', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                delay = self.process_due()
+            except Exception as e:
+                logging.error(f"Email worker error: {e}")
+                delay = self.retry_base
+            self.session.close_if_idle(SESSION_IDLE_SECONDS)
+            self._wake.wait(timeout=delay)
+            self._wake.clear()
+        self.session.close()
+
+    def _next_due_in(self):
+        row = self.database.query_one('''
+            SELECT MIN(CASE status WHEN 'pending' THEN next_attempt_at ELSE lease_until END)
+            FROM email_queue WHERE status IN ('pending', 'sending')
+        ''')
+        if row[0] is None:
+            return SESSION_IDLE_SECONDS
+        return max(0.0, min(row[0] - time.time(), SESSION_IDLE_SECONDS))
+
+    def process_due(self):
+        # Send every message that is due, in batches, over the shared session.
+        # Returns the number of seconds until the next message becomes due.
+        while not self._stop.is_set():
+            now = time.time()
+            rows = self.database.query_all('''
+                SELECT id, recipient, subject, body, attempts FROM email_queue
+                WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'sending' AND lease_until <= ?)
+                ORDER BY next_attempt_at LIMIT ?
+            ''', (now, now, self.batch_size))
+            if not rows:
+                break
+            for row in rows:
+                if self._stop.is_set():
+                    break
+                if self._claim(row[0]):
+                    self._deliver(*row)
+        return self._next_due_in()
+
+    def _claim(self, msg_id):
+        # Take the message for this worker; False if another worker got it first
+        now = time.time()
+        return self.database.execute('''
+            UPDATE email_queue SET status = 'sending', lease_until = ?
+            WHERE id = ? AND (status = 'pending' OR (status = 'sending' AND lease_until <= ?))
+        ''', (now + LEASE_SECONDS, msg_id, now)) == 1
+
+    def _throttle(self):
+        wait = self._last_send + self.min_interval - time.monotonic()
+        if wait > 0:
+            self._stop.wait(wait)
+        self._last_send = time.monotonic()
+
+    def _deliver(self, msg_id, recipient, subject, body, attempts):
+        msg = EmailMessage()
+        msg.set_content(body)
+        msg["Subject"] = subject
+        msg["From"] = self.sender
+        msg["To"] = recipient
+        self._throttle()
+        try:
+            self.session.send(msg)
+        except (smtplib.SMTPException, OSError) as e:
+            self.session.close()
+            attempts += 1
+            permanent = isinstance(e, smtplib.SMTPRecipientsRefused)
+            if permanent or attempts >= self.max_attempts:
+                self.database.execute(
+                    "UPDATE email_queue SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                    (attempts, str(e), msg_id))
+                logging.error(f"Failed to send email to {recipient} after {attempts} attempt(s): {e}")
+            else:
+                backoff = min(self.retry_base * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+                self.database.execute('''
+                    UPDATE email_queue SET status = 'pending', attempts = ?, last_error = ?, next_attempt_at = ?
+                    WHERE id = ?
+                ''', (attempts, str(e), time.time() + backoff, msg_id))
+                logging.warning(f"Email to {recipient} failed (attempt {attempts}), retrying in {backoff}s: {e}")
+        else:
+            self.database.execute("UPDATE email_queue SET status = 'sent', attempts = ? WHERE id = ?",
+                                  (attempts + 1, msg_id))
+            logging.info(f"Email successfully sent to {recipient}")
@@ -0,0 +1,275 @@
+import logging
+import os
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import face_utils
+from encoding_batcher import encoding_batcher
+
+# Recognition worker pool.
+#
+# Face detection, encoding and the mesh hold the GIL for long stretches, so
+# running them on Flask's request threads lets one kiosk stall every other
+# request. RecognitionService runs them in worker processes instead. Each
+# worker loads the models and its own copy of the gallery once, and reloads
+# the gallery when the parent's gallery version changes (after a register or
+# delete). Decoded frames are copied into one shared memory block per
+# request and the worker maps them in place, so only the block name and the
+# frame shapes are pickled. At most max_pending requests are queued or
+# running; beyond that callers get ServiceBusy straight away (HTTP 429)
+# rather than queueing without bound.
+#
+# Every worker is its own single-process executor, so work can be sent to a
+# particular one. Uploaded sequences go to the least loaded worker. Live
+# sessions (see live_sessions.py) stick to the worker that got their first
+# frame, which keeps the session's LivenessSequence between frames; if that
+# worker dies the session starts again from its next frame.
+#
+# RECOGNITION_WORKERS=0 runs recognition in-process, as before.
+
+RECOGNITION_WORKERS = int(os.environ.get('RECOGNITION_WORKERS', min(os.cpu_count() or 1, 4)))
+RECOGNITION_MAX_PENDING = int(os.environ.get('RECOGNITION_MAX_PENDING', 2 * max(RECOGNITION_WORKERS, 1)))
+RECOGNITION_TIMEOUT_SECONDS = float(os.environ.get('RECOGNITION_TIMEOUT_SECONDS', 30))
+
+
+class ServiceBusy(Exception):
+    """Every worker slot is taken; the caller should retry later."""
+
+
+class ServiceUnavailable(Exception):
+    """The worker pool failed or timed out."""
+
+
+# Worker process state
+_worker_gallery_version = None
+# Live sessions handled by this process: session id -> LivenessSequence
+_live_sequences = {}
+
+
+def _worker_init(gallery_version):
+    global _worker_gallery_version
+    # A worker handles one request at a time, so there is nothing to batch
+    # with: encode inline instead of waiting max_wait for company
+    encoding_batcher.max_batch_size = 1
+    face_utils.load_gallery(persist=False)
+    face_utils.warm_up_models()
+    _worker_gallery_version = gallery_version
+
+
+def _sync_gallery(gallery_version):
+    global _worker_gallery_version
+    if gallery_version != _worker_gallery_version:
+        face_utils.load_gallery(persist=False)
+        _worker_gallery_version = gallery_version
+
+
+def _worker_recognize(shm_name, shapes, gallery_version, detector_policy):
+    _sync_gallery(gallery_version)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        imgs = _frames_from_buffer(shm.buf, shapes)
+        stats = {}
+        results = face_utils.recognize_faces_and_liveness_sequence(imgs, stats, detector_policy)
+        del imgs
+        return results, stats
+    finally:
+        shm.close()
+
+
+def _worker_live_frame(shm_name, shapes, gallery_version, session_id, detector_policy, max_history):
+    _sync_gallery(gallery_version)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        imgs = _frames_from_buffer(shm.buf, shapes)
+        result = _live_frame(session_id, imgs[0], detector_policy, max_history)
+        del imgs
+        return result
+    finally:
+        shm.close()
+
+
+def _live_frame(session_id, img, detector_policy, max_history):
+    # (events, current track boxes) for one frame of a live session
+    sequence = _live_sequences.get(session_id)
+    if sequence is None:
+        sequence = face_utils.LivenessSequence(detector_policy, live=True, max_history=max_history)
+        _live_sequences[session_id] = sequence
+    with face_utils.face_mesh_pool.acquire() as fm:
+        events = sequence.feed(img, fm)
+    return events, [{'track_id': t.id, 'box': t.box} for t in sequence.tracker.tracks]
+
+
+def _close_live_sequence(session_id):
+    _live_sequences.pop(session_id, None)
+
+
+def _frames_from_buffer(buf, shapes):
+    imgs, offset = [], 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        imgs.append(np.ndarray(shape, dtype=np.uint8, buffer=buf, offset=offset))
+        offset += size
+    return imgs
+
+
+class RecognitionService:
+    def __init__(self, workers=RECOGNITION_WORKERS, max_pending=RECOGNITION_MAX_PENDING,
+                 timeout=RECOGNITION_TIMEOUT_SECONDS):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executors = []   # one single-process executor per worker
+        self._load = []        # tasks queued or running per worker
+        self._sessions = {}    # live session id -> worker index
+
+    def start(self):
+        # Call after face_utils.load_gallery() so workers start from a
+        # backfilled gallery
+        if self.workers <= 0:
+            return
+        with self._lock:
+            if not self._executors:
+                self._executors = [self._new_executor() for _ in range(self.workers)]
+                self._load = [0] * self.workers
+        logging.info(f"Recognition service started with {self.workers} worker process(es)")
+
+    def _new_executor(self):
+        # spawn, not fork: the parent has running threads and open sqlite
+        # connections that must not be copied into the children
+        return ProcessPoolExecutor(max_workers=1,
+                                   mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_worker_init,
+                                   initargs=(face_utils.get_gallery_version(),))
+
+    def stop(self):
+        with self._lock:
+            executors, self._executors = self._executors, []
+            self._sessions.clear()
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def recognize_sequence(self, imgs, detector_policy='cascade'):
+        # Returns (results, stats) like recognize_faces_and_liveness_sequence.
+        # Raises ServiceBusy when the queue is full and ServiceUnavailable
+        # when a worker crashes or takes longer than the timeout.
+        if not self._executors:
+            with self.slot():
+                stats = {}
+                return face_utils.recognize_faces_and_liveness_sequence(imgs, stats, detector_policy), stats
+        if not self._slots.acquire(blocking=False):
+            raise ServiceBusy()
+        return self._submit(None, _worker_recognize, imgs, detector_policy)
+
+    def live_frame(self, session_id, img, detector_policy='cascade', max_history=None):
+        # Feeds one frame to the live session's LivenessSequence, on the
+        # session's worker. Returns (events, track boxes); raises like
+        # recognize_sequence.
+        if not self._executors:
+            with self.slot():
+                return _live_frame(session_id, img, detector_policy, max_history)
+        if not self._slots.acquire(blocking=False):
+            raise ServiceBusy()
+        return self._submit(session_id, _worker_live_frame, [img], session_id, detector_policy, max_history)
+
+    def close_session(self, session_id):
+        # Drops a live session's state from its worker
+        if not self._executors:
+            _close_live_sequence(session_id)
+            return
+        with self._lock:
+            worker = self._sessions.pop(session_id, None)
+            executor = self._executors[worker] if worker is not None and self._executors else None
+        if executor is None:
+            return
+        try:
+            executor.submit(_close_live_sequence, session_id)
+        except (RuntimeError, BrokenProcessPool):
+            pass  # shut down or broken: the session's state went with it
+
+    @contextmanager
+    def slot(self):
+        # Hold one of the max_pending slots; raises ServiceBusy if none is free
+        if not self._slots.acquire(blocking=False):
+            raise ServiceBusy()
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def _pick_worker(self, session_id):
+        # Caller must hold _lock. The session's worker; for a new session the
+        # one with the fewest sessions, for a sequence the least loaded one
+        worker = self._sessions.get(session_id) if session_id is not None else None
+        if worker is None:
+            pinned = list(self._sessions.values())
+            if session_id is not None:
+                key = lambda w: (pinned.count(w), self._load[w])
+            else:
+                key = lambda w: (self._load[w], pinned.count(w))
+            worker = min(range(len(self._executors)), key=key)
+            if session_id is not None:
+                self._sessions[session_id] = worker
+        self._load[worker] += 1
+        return worker, self._executors[worker]
+
+    def _submit(self, session_id, fn, imgs, *args):
+        # Called holding a slot. The slot and the shared memory are released
+        # once the task has finished, not when this returns: a task that
+        # timed out keeps its worker busy, so it must keep counting against
+        # max_pending.
+        shm, future, worker = None, None, None
+        try:
+            imgs = [np.ascontiguousarray(img, dtype=np.uint8) for img in imgs]
+            shm = shared_memory.SharedMemory(create=True, size=max(sum(img.nbytes for img in imgs), 1))
+            offset = 0
+            for img in imgs:
+                shm.buf[offset:offset + img.nbytes] = img.reshape(-1).data
+                offset += img.nbytes
+            with self._lock:
+                if not self._executors:
+                    raise ServiceUnavailable('Recognition service stopped')
+                worker, executor = self._pick_worker(session_id)
+            future = executor.submit(fn, shm.name, [img.shape for img in imgs],
+                                     face_utils.get_gallery_version(), *args)
+            try:
+                return future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                raise ServiceUnavailable('Recognition timed out')
+            except BrokenProcessPool:
+                logging.error("Recognition worker died; restarting it")
+                self._restart(worker, executor)
+                raise ServiceUnavailable('Recognition worker failed')
+        finally:
+            if future is not None:
+                future.add_done_callback(lambda _: self._release(worker, shm))
+            else:
+                self._release(worker, shm)
+
+    def _release(self, worker, shm):
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+        if worker is not None:
+            with self._lock:
+                if worker < len(self._load):
+                    self._load[worker] -= 1
+        self._slots.release()
+
+    def _restart(self, worker, broken):
+        # Replaces a broken worker (unless another caller already has)
+        with self._lock:
+            if worker >= len(self._executors) or self._executors[worker] is not broken:
+                return
+            self._executors[worker] = self._new_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+
+recognition_service = RecognitionService()
@@ -11,7 +11,7 @@ const attendanceDateInput = document.getElementById('attendanceDate');
 const presentList = document.getElementById('presentList');
 const absentList = document.getElementById('absentList');
 let liveAttendanceActive = false;
-let liveAttendanceInterval = null;
+let liveSession = null; // { id, maxFps, events: EventSource }
 
 // Tab navigation
 const tabBtns = document.querySelectorAll('.tab-btn');
@@ -114,22 +114,35 @@ async function loadUsers() {
     }
 }
 
-// Attendance log
-async function loadLog() {
+// Attendance log (paged: the server returns next_after_id while more rows remain)
+async function loadLog(afterId = null) {
     const logList = document.getElementById('logList');
-    logList.innerHTML = '<div class="spinner"></div>';
+    if (afterId === null) logList.innerHTML = '<div class="spinner"></div>';
     try {
-        const res = await fetch('/attendance_log');
+        const url = afterId === null ? '/attendance_log' : `/attendance_log?after_id=${afterId}`;
+        const res = await fetch(url);
         const data = await res.json();
-        if (data.records && data.records.length > 0) {
-            let html = '<table class="log-table"><thead><tr><th>Name</th><th>Date & Time</th></tr></thead><tbody>';
-            data.records.forEach(r => {
-                html += `<tr><td>${r.name}</td><td>${r.date || ''} ${r.time || ''}</td></tr>`;
-            });
-            html += '</tbody></table>';
-            logList.innerHTML = html;
-        } else {
-            logList.innerHTML = 'No attendance records.';
+        if (afterId === null) {
+            if (!data.records || data.records.length === 0) {
+                logList.innerHTML = 'No attendance records.';
+                return;
+            }
+            logList.innerHTML = '<table class="log-table"><thead><tr><th>Name</th><th>Date & Time</th></tr></thead><tbody></tbody></table>';
+        }
+        const tbody = logList.querySelector('tbody');
+        let html = '';
+        (data.records || []).forEach(r => {
+            html += `<tr><td>${r.name}</td><td>${r.date || ''} ${r.time || ''}</td></tr>`;
+        });
+        tbody.insertAdjacentHTML('beforeend', html);
+        const oldMore = document.getElementById('logMoreBtn');
+        if (oldMore) oldMore.remove();
+        if (data.next_after_id !== null && data.next_after_id !== undefined) {
+            const more = document.createElement('button');
+            more.id = 'logMoreBtn';
+            more.textContent = 'Load more';
+            more.onclick = () => loadLog(data.next_after_id);
+            logList.appendChild(more);
         }
     } catch (e) {
         logList.innerHTML = 'Failed to load log.';
@@ -158,6 +171,72 @@ function captureImage() {
     return canvas.toDataURL('image/jpeg').split(',')[1]; // base64 without prefix
 }
 
+// Capture settings advertised by the server (GET /capture_settings); these
+// defaults are used until a live session returns the real ones
+let captureSettings = { short_side: 480, jpeg_quality: [0.5, 0.9], crop_padding: 0.5, full_frame_every: 10 };
+let jpegQuality = 0.8;
+const cropCanvas = document.createElement('canvas');
+
+// Draw the current video frame into the capture canvas, scaled down so its
+// short side matches what the server detects at (never scaled up)
+function drawScaledFrame() {
+    const scale = Math.min(1, captureSettings.short_side / Math.min(video.videoWidth, video.videoHeight));
+    canvas.width = Math.round(video.videoWidth * scale);
+    canvas.height = Math.round(video.videoHeight * scale);
+    canvas.getContext('2d').drawImage(video, 0, 0, canvas.width, canvas.height);
+}
+
+function canvasToBlob(c, quality) {
+    return new Promise(resolve => c.toBlob(resolve, 'image/jpeg', quality));
+}
+
+// Capture a frame as a binary JPEG Blob (no base64 inflation)
+function captureImageBlob() {
+    drawScaledFrame();
+    return canvasToBlob(canvas, jpegQuality);
+}
+
+// Capture only padded crops around the given [top, right, bottom, left]
+// boxes, with their offsets in the scaled frame
+async function captureCrops(boxes) {
+    drawScaledFrame();
+    const crops = [];
+    for (const [top, right, bottom, left] of boxes) {
+        const pad = Math.max(right - left, bottom - top) * captureSettings.crop_padding;
+        const x = Math.max(0, Math.floor(left - pad));
+        const y = Math.max(0, Math.floor(top - pad));
+        const w = Math.min(canvas.width, Math.ceil(right + pad)) - x;
+        const h = Math.min(canvas.height, Math.ceil(bottom + pad)) - y;
+        if (w <= 0 || h <= 0) continue;
+        cropCanvas.width = w;
+        cropCanvas.height = h;
+        cropCanvas.getContext('2d').drawImage(canvas, x, y, w, h, 0, 0, w, h);
+        crops.push({ x, y, blob: await canvasToBlob(cropCanvas, jpegQuality) });
+    }
+    return { width: canvas.width, height: canvas.height, crops };
+}
+
+// Pack JPEG blobs into one body: each frame is a 4-byte big-endian length
+// followed by the JPEG bytes
+async function packFrames(blobs) {
+    const parts = [];
+    for (const blob of blobs) {
+        const len = new Uint8Array(4);
+        new DataView(len.buffer).setUint32(0, blob.size);
+        parts.push(len, blob);
+    }
+    return new Blob(parts, { type: 'application/octet-stream' });
+}
+
+// Lower the JPEG quality when uploading a frame took longer than its time
+// budget, raise it again when there is plenty of headroom. Only the transfer
+// counts: server-side recognition time doesn't depend on the JPEG quality.
+function adaptQuality(elapsedMs, budgetMs) {
+    const [minQ, maxQ] = captureSettings.jpeg_quality;
+    if (elapsedMs > budgetMs) jpegQuality = Math.max(minQ, jpegQuality - 0.1);
+    else if (elapsedMs < budgetMs / 2) jpegQuality = Math.min(maxQ, jpegQuality + 0.05);
+}
+
 registerBtn.onclick = async () => {
     const name = nameInput.value.trim();
     const email = emailInput.value.trim();
@@ -188,57 +267,93 @@ registerBtn.onclick = async () => {
     }
 };
 
-async function captureAndSendAttendance() {
-    resultDiv.textContent = 'Capturing for liveness (please blink)...';
-    showToast('Capturing for liveness (please blink)...', 1800);
-    // Capture a burst of frames (e.g., 20 frames over 2 seconds)
-    const frames = [];
-    const numFrames = 20;
-    const interval = 100; // ms between frames (20 frames in 2 seconds)
-    for (let i = 0; i < numFrames; i++) {
-        frames.push(captureImage());
-        await new Promise(res => setTimeout(res, interval));
+// Live attendance: frames are streamed one at a time to a server-side
+// session, which keeps tracking / blink state and pushes back events as soon
+// as a face is recognised, blinks, or is marked.
+async function startLiveSession() {
+    const res = await fetch('/live_session', { method: 'POST' });
+    const data = await res.json();
+    if (!data.success) throw new Error(data.error || 'Could not start live session');
+    if (data.capture) captureSettings = data.capture;
+    const session = { id: data.session_id, maxFps: data.max_fps || 5, events: null, boxes: [], frames: 0 };
+    session.events = new EventSource(`/live_session/${session.id}/events`);
+    session.events.onmessage = e => handleLiveEvent(JSON.parse(e.data));
+    return session;
+}
+
+function handleLiveEvent(ev) {
+    if (ev.event === 'marked') {
+        if (ev.newly_marked) {
+            resultDiv.innerHTML = `Attendance marked for: <b>${ev.name}</b>`;
+            showToast(`Attendance marked for ${ev.name}!`);
+            // Refresh attendance status for the selected date
+            loadAttendanceStatus(attendanceDateInput.value);
+        } else {
+            resultDiv.innerHTML = `<b>${ev.name}</b> is already marked present today.`;
+        }
+    } else if (ev.event === 'face') {
+        resultDiv.textContent = ev.name
+            ? `Recognized ${ev.name}, please blink to verify liveness...`
+            : 'Unknown face detected.';
     }
-    resultDiv.textContent = 'Checking attendance...';
-    showToast('Checking attendance...', 1200);
-    try {
-        const res = await fetch('/attendance', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ images: frames })
-        });
-        const data = await res.json();
-        if (data.success) {
-            if (data.names && data.names.length > 0) {
-                resultDiv.innerHTML = `Attendance marked for: <b>${data.names.join(', ')}</b>`;
-                showToast('Attendance marked!');
-                // Refresh attendance status for the selected date
-                loadAttendanceStatus(attendanceDateInput.value);
+}
+
+// Send frames one at a time (never more than one in flight), at most
+// session.maxFps per second. While faces are tracked only crops around them
+// are sent, with a full frame every full_frame_every frames so new faces
+// are picked up.
+async function pumpFrames(session) {
+    while (liveAttendanceActive && liveSession === session) {
+        const started = performance.now();
+        try {
+            let body, headers;
+            const frame = session.boxes.length > 0 && session.frames % captureSettings.full_frame_every !== 0
+                ? await captureCrops(session.boxes) : null;
+            if (!frame || frame.crops.length === 0) {
+                body = await captureImageBlob();
+                headers = { 'Content-Type': 'image/jpeg' };
             } else {
-                // Check if any faces were detected but not real
-                const detected = (data.details || []).filter(d => d.name);
-                const fake = (data.details || []).filter(d => d.name && !d.liveness);
-                if (detected.length === 0) {
-                    resultDiv.textContent = 'No recognized faces detected.';
-                    showToast('No recognized faces detected.');
-                } else if (fake.length > 0) {
-                    resultDiv.textContent = 'Detected faces, but liveness verification failed (please blink, do not use a photo).';
-                    showToast('Liveness verification failed.');
-                } else {
-                    resultDiv.textContent = 'No real (live) recognized faces detected.';
-                    showToast('No real (live) recognized faces detected.');
-                }
+                body = await packFrames(frame.crops.map(c => c.blob));
+                headers = {
+                    'Content-Type': 'application/octet-stream',
+                    'X-Frame-Layout': JSON.stringify({
+                        width: frame.width,
+                        height: frame.height,
+                        crops: frame.crops.map(c => [c.x, c.y])
+                    })
+                };
             }
-        } else {
-            resultDiv.textContent = 'Attendance failed.';
-            showToast('Attendance failed.');
+            session.frames++;
+            const sent = performance.now();
+            const res = await fetch(`/live_session/${session.id}/frame`, { method: 'POST', headers, body });
+            if (res.status === 404) {
+                // Session expired (e.g. server restart): open a new one
+                session.events.close();
+                liveSession = await startLiveSession();
+                pumpFrames(liveSession);
+                return;
+            }
+            const data = await res.json();
+            if (data.success) {
+                session.boxes = (data.tracks || []).map(t => t.box);
+                const processingMs = parseFloat(res.headers.get('X-Processing-Ms')) || 0;
+                adaptQuality(performance.now() - sent - processingMs, 1000 / session.maxFps);
+            }
+        } catch (e) {
+            resultDiv.textContent = 'Live attendance: network error, retrying...';
         }
-    } catch (e) {
-        resultDiv.textContent = 'Attendance failed: Network error.';
-        showToast('Attendance failed: Network error.');
+        const wait = 1000 / session.maxFps - (performance.now() - started);
+        if (wait > 0) await new Promise(res => setTimeout(res, wait));
     }
 }
 
+function stopLiveSession() {
+    if (!liveSession) return;
+    liveSession.events.close();
+    fetch(`/live_session/${liveSession.id}`, { method: 'DELETE' }).catch(() => {});
+    liveSession = null;
+}
+
 attendanceBtn.onclick = async () => {
     if (!isAdmin) {
         showAdminLogin();
@@ -248,12 +363,19 @@ attendanceBtn.onclick = async () => {
     liveAttendanceActive = true;
     attendanceBtn.disabled = true;
     stopAttendanceBtn.style.display = '';
+    try {
+        liveSession = await startLiveSession();
+    } catch (e) {
+        liveAttendanceActive = false;
+        attendanceBtn.disabled = false;
+        stopAttendanceBtn.style.display = 'none';
+        resultDiv.textContent = 'Could not start live attendance: ' + e.message;
+        showToast('Could not start live attendance.');
+        return;
+    }
+    resultDiv.textContent = 'Live attendance running. Look at the camera and blink.';
     showToast('Live attendance started!');
-    // Run immediately, then every 3 seconds
-    await captureAndSendAttendance();
-    liveAttendanceInterval = setInterval(() => {
-        if (liveAttendanceActive) captureAndSendAttendance();
-    }, 3000);
+    pumpFrames(liveSession);
 };
 
 stopAttendanceBtn.onclick = () => {
@@ -262,7 +384,7 @@ stopAttendanceBtn.onclick = () => {
     stopAttendanceBtn.style.display = 'none';
     resultDiv.textContent = 'Live attendance stopped.';
     showToast('Live attendance stopped.');
-    if (liveAttendanceInterval) clearInterval(liveAttendanceInterval);
+    stopLiveSession();
 };
 
 function getTodayDateStr() {